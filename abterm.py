@@ -1,4 +1,5 @@
-from app import ABTerm
+import argparse
+import sys
 
 # the config file is currently Python-like; could technically import it instead
 # TODO: should put it into user's home dir; this is reliant on relative path
@@ -6,10 +7,22 @@ CONFIG_FILE = "config.txt"
 
 BASE_URL = "https://dev.azure.com"
 
+# Optional keys, and their defaults
+OPTIONAL_KEYS = {
+    'HISTORY_WORKERS': '8',
+    'DISK_CACHE': 'true',
+    'CACHE_SIZE': '20000',
+    'CARD_CACHE_TTL': '3600',
+    'SPRINT_CACHE_TTL': '300',
+    'PREFETCH_SPRINTS': '1',
+    'POOL_SIZE': '16',
+    'REQUEST_TIMEOUT': '30',
+}
+
 def read_config():
     expected_keys = ['ORGANISATION', 'PROJECT', 'TEAM', 'TOKEN']
     with open(CONFIG_FILE, "r") as f:
-        config = {}
+        config = dict(OPTIONAL_KEYS)
         for line in f:
             key, value = line.split("=")
             config[key.strip()] = value.strip(" \"'\n")
@@ -18,7 +31,102 @@ def read_config():
                 raise ValueError(f"Missing required key in config: {key}")
     return config
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Azure Boards Terminal")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="append a JSON line to FILE for every API request made (and every one the caches saved)")
+    parser.add_argument('--export', choices=['jsonl', 'csv'],
+                        help="instead of starting the terminal UI, write the cards of sprints (by default the current one) "
+                             "to standard output in this format")
+    parser.add_argument('--metrics', choices=['jsonl', 'csv'],
+                        help="instead of starting the terminal UI, write velocity and flow metrics for each sprint "
+                             "(by default every sprint) to standard output in this format")
+    parser.add_argument('--flow', action='store_true',
+                        help="with --metrics, write cumulative flow data (cards in each state each day) instead")
+    parser.add_argument('--sprint', action='append', metavar='NAME',
+                        help="a sprint to export, by name or iteration path; can be given more than once")
+    parser.add_argument('--all-sprints', action='store_true', help="export every sprint of the team")
+    parser.add_argument('--output', metavar='FILE', help="export to FILE rather than standard output")
+    parser.add_argument('--state', action='append', metavar='STATE', help="only export cards in STATE; can be repeated")
+    parser.add_argument('--exclude-state', action='append', metavar='STATE',
+                        help="don't export cards in STATE; can be repeated")
+    parser.add_argument('--type', action='append', metavar='TYPE',
+                        help="only export cards of TYPE (e.g. 'User Story'); can be repeated")
+    parser.add_argument('--assigned-to', metavar='NAME', help="only export cards assigned to NAME (or @Me)")
+    parser.add_argument('--sprint-workers', type=int, default=4, help="how many sprints to export at once (default: 4)")
+    return parser.parse_args()
+
+def export(config, args):
+    """Write the cards of the chosen sprints, or metrics for them, without the terminal UI. Returns the exit status."""
+    from api import (ApiConnection, CardClient, CardFilter, SprintClient, DiskCache, RequestLog, SprintExporter,
+                     DONE_STATES, CARD_FIELDS, FLOW_FIELDS, SPRINT_METRIC_FIELDS, WRITERS)
+    connection = ApiConnection(BASE_URL, config['ORGANISATION'], config['TOKEN'],
+                               pool_size=int(config['POOL_SIZE']), timeout=int(config['REQUEST_TIMEOUT']),
+                               request_log=RequestLog(args.trace) if args.trace else None)
+    disk_cache = DiskCache(config['ORGANISATION'], config['PROJECT']) if config['DISK_CACHE'].lower() == 'true' else None
+    sprint_client = SprintClient(connection, config['PROJECT'], config['TEAM'],
+                                 sprint_ttl=int(config['SPRINT_CACHE_TTL']), disk_cache=disk_cache)
+    card_client = CardClient(connection, config['PROJECT'], history_workers=int(config['HISTORY_WORKERS']),
+                             disk_cache=disk_cache, cache_size=int(config['CACHE_SIZE']),
+                             card_ttl=int(config['CARD_CACHE_TTL']), card_fields=CARD_FIELDS)
+    sprints = sprint_client.get_sprints()
+    if args.all_sprints or (args.metrics and not args.sprint):
+        chosen = sprints
+    elif args.sprint:
+        by_name = {sprint.name: sprint for sprint in sprints}
+        by_name.update({sprint.path: sprint for sprint in sprints})
+        unknown = [name for name in args.sprint if name not in by_name]
+        if unknown:
+            print(f"Unknown sprints: {', '.join(unknown)}", file=sys.stderr)
+            return 2
+        chosen = [by_name[name] for name in args.sprint]
+    else:
+        current = sprint_client.get_current_sprint(sprints)
+        chosen = [] if current is None else [current]
+    if card_client.cache.stale and not args.metrics:
+        # Catch up with changes made since the on-disk cache was last synced
+        card_client.refresh_changed(sprint_client)
+    synced = card_client.cache.get_history_watermark()[0] is not None
+    if args.all_sprints or args.metrics or synced:
+        # Initial sprints for every card from a few pages of history, rather than a lookup or two per card.
+        # That only pays off for many sprints, or once the disk cache has synced before and only what changed is read
+        card_client.sync_history()
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.metrics:
+            # Worked out from the history just synced, without fetching any cards
+            rows, flow = card_client.get_flow_metrics(chosen, DONE_STATES, types=args.type)
+            fields, records = (FLOW_FIELDS, flow) if args.flow else (SPRINT_METRIC_FIELDS, rows)
+            writer = WRITERS[args.metrics](output, fields)
+            for record in records:
+                writer.write(record)
+            return 0
+        card_filter = CardFilter(states=args.state, exclude_states=args.exclude_state,
+                                 assigned_to=args.assigned_to, types=args.type)
+        exporter = SprintExporter(card_client, sprint_client, sprint_workers=args.sprint_workers,
+                                  card_filter=card_filter)
+        failed = exporter.export(chosen, WRITERS[args.export](output))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    for sprint_name, error in failed.items():
+        print(f"Failed to export {sprint_name}: {error}", file=sys.stderr)
+    return 1 if failed else 0
+
 if __name__ == "__main__":
+    args = parse_args()
     config = read_config()
-    app = ABTerm(BASE_URL, config['ORGANISATION'], config['PROJECT'], config['TEAM'], config['TOKEN'])
+    if args.export or args.metrics:
+        sys.exit(export(config, args))
+    from app import ABTerm
+    app = ABTerm(BASE_URL, config['ORGANISATION'], config['PROJECT'], config['TEAM'], config['TOKEN'],
+                 history_workers=int(config['HISTORY_WORKERS']),
+                 disk_cache=config['DISK_CACHE'].lower() == 'true',
+                 cache_size=int(config['CACHE_SIZE']),
+                 card_ttl=int(config['CARD_CACHE_TTL']),
+                 sprint_ttl=int(config['SPRINT_CACHE_TTL']),
+                 prefetch_sprints=int(config['PREFETCH_SPRINTS']),
+                 pool_size=int(config['POOL_SIZE']),
+                 timeout=int(config['REQUEST_TIMEOUT']),
+                 trace=args.trace)
     app.run()
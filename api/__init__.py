@@ -1,3 +1,12 @@
 
 from .cardclient import *
-from .sprintclient import *
\ No newline at end of file
+from .cardfilter import *
+from .cardstore import *
+from .flowmetrics import *
+from .pagedquery import *
+from .scheduler import *
+from .sprintclient import *
+from .diskcache import *
+from .connection import *
+from .instrumentation import *
+from .export import *
\ No newline at end of file
@@ -0,0 +1,42 @@
+"""
+When to retry Azure DevOps calls that failed, and how long to wait first
+"""
+
+import random
+
+# Response statuses worth retrying: throttled, timed out, or the server (or a proxy in front of it) briefly failing
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+
+def is_throttled(error, status=None):
+    """Whether a failed call got a 429 (Too Many Requests) response. status is the response's, if we know it"""
+    if status is not None:
+        return status == 429
+    # The SDK doesn't keep the status code on its exceptions, only in the message
+    message = str(error)
+    return '429' in message or 'Too Many Requests' in message
+
+def is_transient(error, status=None):
+    """
+    Whether a failed call is worth retrying. status is the HTTP status of its response, if we know it;
+    None if there was no response, or we don't know.
+    """
+    # Here rather than at the top, as msrest is slow to import
+    from msrest.exceptions import ClientRequestError
+    if status is not None:
+        return status in TRANSIENT_STATUSES
+    if not isinstance(error, ClientRequestError):
+        return False
+    if is_throttled(error):
+        return True
+    message = str(error)
+    if any(f"{code} status code" in message for code in TRANSIENT_STATUSES):
+        return True
+    # msrest raises a plain ClientRequestError when nothing came back at all, e.g. the connection dropped or timed out
+    return type(error) is ClientRequestError
+
+def retry_delay(attempt, delay=1.0, retry_after=None):
+    """Seconds to wait before retry number attempt (from 0): what the server asked for, or exponential backoff"""
+    if retry_after is not None:
+        return retry_after
+    # Jitter so parallel calls don't all retry at the same moment
+    return delay * 2**attempt * random.uniform(1, 1.5)
@@ -2,46 +2,133 @@
 This wraps the WorkItems API; it covers the backlog and manipulation of individual cards
 """
 
-from azure.devops.connection import Connection
-from msrest.authentication import BasicAuthentication
-from azure.devops.v7_0.work_item_tracking.models import Wiql, WorkItemBatchGetRequest, JsonPatchOperation
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from contextvars import copy_context
+from datetime import datetime, timedelta, timezone
+
+# The SDK models are imported where they are used, as the SDK is slow to import and isn't needed to start up
+
+from .cardfilter import wiql_string
+from .flowmetrics import DONE_STATES, FlowMetrics, RevisionLog
+from .historyfeed import HISTORY_FIELDS, HistoryFeed
+from .lru import LRUCache
+from .pagedquery import PagedQuery
+from .scheduler import background_priority
+
+# Most IDs the API accepts in one batch request
+BATCH_SIZE = 200
+
+# The card fields the cards table and exports are built from, and the only ones fetched for them
+CARD_FIELDS = [
+    'System.WorkItemType',   # ID colour, and indenting tasks
+    'System.Title',
+    'System.State',
+    'System.AssignedTo',
+    'System.Parent',         # Feature and Epic, by walking up the parents
+    'System.IterationPath',  # Moving cards between sprints
+    'System.ChangedDate',    # Keeping the on-disk cache fresh
+]
+
+# The only fields we need from a parent card to display and keep walking the hierarchy
+PARENT_FIELDS = ['System.WorkItemType', 'System.Title', 'System.Parent']
+
+# Allowance for our clock differing from the server's when syncing by ChangedDate
+CLOCK_SKEW = timedelta(minutes=5)
+
+def utc_now():
+    """The current time as a WIQL-friendly UTC timestamp, backdated by CLOCK_SKEW"""
+    return (datetime.now(timezone.utc) - CLOCK_SKEW).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def fields_key(fields):
+    """A hashable version of a list of fields (None meaning all fields)"""
+    return frozenset(fields) if fields else None
+
+# The expand options each expand option includes
+EXPAND_COVERS = {
+    None: {None},
+    'fields': {None, 'fields'},
+    'relations': {None, 'relations'},
+    'links': {None, 'links'},
+    'all': {None, 'fields', 'relations', 'links', 'all'},
+}
+
+def covers(held_fields, held_expand, fields, expand):
+    """Whether a card fetched with held_fields and held_expand has everything a request for fields and expand needs"""
+    if expand not in EXPAND_COVERS.get(held_expand, {held_expand}):
+        return False
+    if held_fields is None:
+        return True
+    return fields is not None and set(fields) <= held_fields
+
 
 class CardClient:
-    def __init__(self, base_url, org, project, token):
+    def __init__(self, connection, project, history_workers=8, disk_cache=None,
+                 cache_size=20000, card_ttl=3600, batch_workers=4, card_fields=None):
+        """
+        connection is the ApiConnection shared with other clients.
+        card_fields are the only fields to fetch for sprint cards; None means all fields, with relations.
+        """
         self.project = project
-        credentials = BasicAuthentication('', token)
-        connection = Connection(base_url=f"{base_url}/{org}", creds=credentials)
-        self.client = connection.clients.get_work_item_tracking_client()
-        self.cache = WorkItemCache(self.client)
+        self.card_fields = card_fields
+        # Number of card history lookups to run at once
+        self.history_workers = history_workers
+        # Number of batch requests to run at once
+        self.batch_workers = batch_workers
+        # Count of fetches the user is waiting for; background prefetching waits while there are any
+        self.foreground_fetches = 0
+        self.foreground_done = threading.Condition()
+        self.client = connection.get_work_item_tracking_client()
+        self.cache = WorkItemCache(self.client, disk_cache=disk_cache, max_size=cache_size, card_ttl=card_ttl,
+                                   request_log=connection.request_log)
+        self.history_feed = HistoryFeed(self.client, project, self.cache)
 
     def add_state_to_card(self, card):
         """Add state as a top-level entry on the dict"""
-        card['state'] = card['fields']['System.State']
+        card['state'] = card['fields'].get('System.State')
         return card
 
-    def get_epics(self):
-        """Get all Epics in self.project"""
-        # If no fields provided, gets all fields
-        # TODO allow taking fields as input to function
-        query = Wiql("SELECT * FROM WorkItems WHERE [System.WorkItemType] = 'Epic'")
-        listing = self.client.query_by_wiql(query)
-        # TODO should check listing is not over 200 items, and batch
-        ids = [item.id for item in listing.work_items]
-        if len(ids)==0:
-            return []
-        epics = self.cache.get_work_items_batch(self.project, ids)
+    def get_epics(self, fields=None):
+        """Get all Epics in self.project (with just fields, if given)"""
+        epics = [epic for page in self.iter_epics(fields) for epic in page]
         return [self.add_state_to_card(epic.as_dict()) for epic in epics]
 
+    def iter_epics(self, fields=None):
+        """Yield the Epics in self.project a page at a time, as each page is fetched"""
+        return self.iter_query([f"[System.WorkItemType] = {wiql_string('Epic')}"], fields)
+
+    def iter_query(self, conditions, fields=None, page_size=BATCH_SIZE * 5):
+        """
+        Yield the cards matching WIQL conditions a page at a time, as each page is fetched, in ID order.
+        Any number of cards can be walked through, past the limit on what one WIQL query can return.
+        """
+        for card_ids in PagedQuery(self.client, self.project, conditions, page_size=page_size).pages():
+            yield self.get_cards_batch(card_ids, fields=fields)
+
     def get_children(self, card_id, fields=None):
         """Get all children of the given card"""
-        workitem = self.cache.get_work_item(card_id, expand='relations')
-        child_ids = [item['url'].split('/')[-1] for item in workitem.as_dict()['relations'] if item['attributes']['name']=='Child']
-        if len(child_ids)==0:
-            return []
-        # TODO should check listing is not over 200 items, and batch
-        cards = self.cache.get_work_items_batch(self.project, child_ids, fields=fields)
+        cards = self.get_children_batch([card_id], fields=fields)[int(card_id)]
         return [self.add_state_to_card(card.as_dict()) for card in cards]
 
+    def get_children_batch(self, card_ids, fields=None):
+        """
+        Get the children of several cards at once, as {card ID: [child cards]} (in ID order).
+        The children are found with a query per BATCH_SIZE parents, rather than fetching each parent's relations.
+        """
+        card_ids = [int(card_id) for card_id in card_ids]
+        if fields and 'System.Parent' not in fields:
+            # Needed to tell whose child each card is
+            fields = list(fields) + ['System.Parent']
+        children = {card_id: [] for card_id in card_ids}
+        for start in range(0, len(card_ids), BATCH_SIZE):
+            parent_ids = ", ".join(str(card_id) for card_id in card_ids[start:start+BATCH_SIZE])
+            for page in self.iter_query([f"[System.Parent] IN ({parent_ids})"], fields):
+                for card in page:
+                    children[card.fields['System.Parent']].append(card)
+        return children
+
     def get_card(self, card_id):
         """Get a single card by ID"""
         card = self.cache.get_work_item(card_id, expand='relations')
@@ -49,49 +136,211 @@ class CardClient:
 
     def update_card_state(self, card_id, new_state):
         """Set card state to requested state"""
+        from azure.devops.v7_0.work_item_tracking.models import JsonPatchOperation
         action = JsonPatchOperation(op='Replace', path='/fields/System.State', value=new_state)
-        result = self.client.update_work_item([action], card_id).as_dict()
-        if not result['fields']['System.State'] == new_state:
+        card = self.client.update_work_item([action], card_id)
+        if not card.fields['System.State'] == new_state:
             raise Exception(f"Failed to update card {card_id} to state {new_state}")
-        # Drop any versions of this card from the cache
-        self.cache.reset_card(card_id)
-        return result
+        # The response is the updated card, so bring cached versions up to date rather than refetching
+        self.cache.apply_update(card)
+        return card.as_dict()
     
-    def update_card_sprint(self, card_id, sprint_path, sprint_client):
-        """Set card iteration path to requested sprint path"""
+    def update_card_sprint(self, card_id, sprint_path, sprint_client=None):
+        """
+        Set card iteration path to requested sprint path.
+        Without a sprint_client, cached sprint contents are left for the caller to invalidate.
+        """
+        from azure.devops.v7_0.work_item_tracking.models import JsonPatchOperation
         action = JsonPatchOperation(op='Replace', path='/fields/System.IterationPath', value=sprint_path)
-        result = self.client.update_work_item([action], card_id).as_dict()
-        if not result['fields']['System.IterationPath'] == sprint_path:
+        card = self.client.update_work_item([action], card_id)
+        if not card.fields['System.IterationPath'] == sprint_path:
             raise Exception(f"Failed to update card {card_id} to sprint {sprint_path}")
-        # Drop any versions of this card from the cache
-        self.cache.reset_card(card_id)
-        # For now drop the whole iterations cache whenever we move a card - this doesn't drop card details
-        sprint_client.cache.reset()
-        return result
+        # The response is the updated card, so bring cached versions up to date rather than refetching
+        self.cache.apply_update(card)
+        # Only the contents of the sprints it moved between have changed
+        if sprint_client is not None:
+            sprint_client.cache.invalidate([card_id], [sprint_path])
+        return card.as_dict()
+
+    def update_cards_state(self, card_ids, new_state):
+        """
+        Set the state of several cards, sending up to self.batch_workers updates at once.
+        Returns the updated cards, and a dict of {card_id: exception} for those that failed.
+        """
+        return self.update_cards(card_ids, lambda card_id: self.update_card_state(card_id, new_state))
+
+    def update_cards_sprint(self, card_ids, sprint_path, sprint_client):
+        """
+        Set the iteration path of several cards, sending up to self.batch_workers updates at once.
+        Returns the updated cards, and a dict of {card_id: exception} for those that failed.
+        """
+        updated, failed = self.update_cards(card_ids, lambda card_id: self.update_card_sprint(card_id, sprint_path))
+        # Once for all the cards
+        sprint_client.cache.invalidate([card['id'] for card in updated], [sprint_path])
+        return updated, failed
+
+    def update_cards(self, card_ids, update):
+        """Call update(card_id) for each card in parallel, collecting results and failures."""
+        updated = []
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.batch_workers) as executor:
+            futures = {executor.submit(copy_context().run, update, card_id): card_id
+                       for card_id in card_ids}
+            for future in as_completed(futures):
+                try:
+                    updated.append(future.result())
+                except Exception as e:
+                    failed[futures[future]] = e
+        return updated, failed
     
-    def get_sprint_cards(self, sprint_id, sprint_client):
+    def get_sprint_cards(self, sprint_id, sprint_client, card_filter=None):
+        """Get the cards in a sprint, in backlog order, optionally only those passing a CardFilter"""
+        return self.get_cards(self.get_sprint_card_ids(sprint_id, sprint_client, card_filter))
+
+    def get_sprint_card_ids(self, sprint_id, sprint_client, card_filter=None):
+        """
+        Get the IDs of the cards in a sprint, in backlog order.
+        A CardFilter is applied by the server, so cards it leaves out are never fetched.
+        """
         cardrefs = sprint_client.get_sprint_cardrefs(sprint_id)
         card_ids = [cardref.target.id for cardref in cardrefs.work_item_relations]
-        cards = []
-        while len(card_ids) > 0:
-            # Get a batch of cards, up to 200 at a time (API limit)
-            batch_ids = card_ids[:200]
-            card_ids = card_ids[200:]
-            batch = self.cache.get_work_items_batch(self.project, batch_ids, expand='relations')
-            cards += batch
-        return cards
+        if card_filter is None or card_filter.is_empty():
+            return card_ids
+        from azure.devops.v7_0.work_item_tracking.models import Wiql
+        query = Wiql(card_filter.wiql(self.project, sprint_client.get_sprint_path(sprint_id)))
+        listing = self.client.query_by_wiql(query)
+        matching = {item.id for item in listing.work_items}
+        # The query results aren't in backlog order, so keep the sprint's order
+        return [card_id for card_id in card_ids if card_id in matching]
+
+    def get_cards(self, card_ids):
+        """Get cards as sprint cards are shown: with just self.card_fields if set, otherwise everything"""
+        if self.card_fields:
+            return self.get_cards_batch(card_ids, fields=self.card_fields)
+        return self.get_cards_batch(card_ids, expand='relations')
+
+    def get_cards_batch(self, card_ids, fields=None, expand=None):
+        """
+        Get any number of cards, using the cache where possible.
+        IDs are split into API-sized batches, and up to self.batch_workers batches are fetched at once.
+        Cards are returned in the order of card_ids, leaving out any that don't exist.
+        """
+        card_ids = list(card_ids)
+        batches = [card_ids[start:start+BATCH_SIZE] for start in range(0, len(card_ids), BATCH_SIZE)]
+        def get_batch(batch_ids):
+            return self.cache.get_work_items_batch(self.project, batch_ids, fields=fields, expand=expand)
+        if len(batches) <= 1:
+            # Not worth a thread
+            return [card for batch_ids in batches for card in get_batch(batch_ids)]
+        with ThreadPoolExecutor(max_workers=self.batch_workers) as executor:
+            # Copying the context keeps the requests counted towards the current load
+            futures = [executor.submit(copy_context().run, get_batch, batch_ids) for batch_ids in batches]
+            return [card for future in futures for card in future.result()]
+
+    def refresh_changed(self, sprint_client):
+        """
+        Bring the caches up to date with the cards changed since the cache watermark: those we had cached are
+        refetched, and cached parents that depend on a changed card are dropped.
+        Cached sprint contents are dropped too, as cards we never fetched may have moved into or out of them
+        (at startup, when this usually runs, there are none).
+        Returns the IDs of the changed cards.
+        """
+        watermark = utc_now()
+        # Without time precision WIQL compares dates only
+        query = PagedQuery(self.client, self.project, [f"[System.ChangedDate] > '{self.cache.watermark}'"],
+                           time_precision=True)
+        changed_ids = query.ids()
+        held = self.cache.held(changed_ids)
+        self.cache.invalidate(changed_ids)
+        # The same version of the cards that get_sprint_cards uses, only for the cards we had, not the whole project
+        self.get_cards([card_id for card_id in changed_ids if str(card_id) in held])
+        sprint_client.cache.reset()
+        self.cache.set_watermark(watermark)
+        self.cache.stale = False
+        return changed_ids
+
+    @contextmanager
+    def foreground(self):
+        """Mark a fetch the user is waiting for, pausing background prefetching until it's done"""
+        with self.foreground_done:
+            self.foreground_fetches += 1
+        try:
+            yield
+        finally:
+            with self.foreground_done:
+                self.foreground_fetches -= 1
+                self.foreground_done.notify_all()
+
+    def wait_for_foreground(self):
+        """Block until no foreground fetches are running"""
+        with self.foreground_done:
+            self.foreground_done.wait_for(lambda: self.foreground_fetches == 0)
+
+    def prefetch_sprint(self, sprint_id, sprint_client, is_cancelled=lambda: False):
+        """
+        Warm the caches with everything needed to show a sprint's cards, at low priority:
+        we wait for foreground fetches before each request, and fetch card histories one at a time.
+        The requests are also background ones to the scheduler, so give way to any from other clients.
+        Stops early if is_cancelled() becomes true.
+        """
+        with background_priority():
+            self.wait_for_foreground()
+            cards = self.get_sprint_cards(sprint_id, sprint_client)
+            self.wait_for_foreground()
+            self.add_parents(cards)
+            for card in cards:
+                self.wait_for_foreground()
+                if is_cancelled():
+                    return
+                self.add_initial_sprint(card)
+
+    def sync_history(self, is_cancelled=lambda: False):
+        """
+        Cache the initial sprints of all the cards in the project, from the revisions made since the last sync,
+        a page of revisions (of many cards) per request. Cards looked up afterwards need no history requests.
+        Runs at low priority: we wait for foreground fetches before each page. Stops early if is_cancelled() becomes true.
+        Returns how many cards were found to have an initial sprint.
+        """
+        def should_stop():
+            self.wait_for_foreground()
+            return is_cancelled()
+        self.wait_for_foreground()
+        with background_priority():
+            return self.history_feed.sync(should_stop)
+
+    def get_flow_metrics(self, sprints, done_states=DONE_STATES, types=None):
+        """
+        Velocity and flow metrics for the given sprints (see FlowMetrics), worked out from the revisions cached by
+        sync_history, without any requests. Returns (a row per sprint, cumulative flow rows).
+        """
+        return FlowMetrics(sprints, done_states, types=types).compute(self.cache.get_revision_log())
 
     def add_initial_sprint(self, card):
         """Add the initial sprint as a top-level field on the card"""
-        if card.id in self.cache.card_history_cache:
-            initial_sprint = self.cache.card_history_cache[card.id]
+        initial_sprint = self.cache.get_initial_sprint(card.id)
+        if initial_sprint is not None:
             card.fields['Initial Sprint'] = initial_sprint
             return card
         initial_sprint = self.get_card_initial_sprint(card.id)
-        self.cache.card_history_cache[card.id] = initial_sprint
+        self.cache.set_initial_sprint(card.id, initial_sprint)
         card.fields['Initial Sprint'] = initial_sprint
         return card
 
+    def iter_initial_sprints(self, cards):
+        """
+        Add the initial sprint to each of the given cards, looking up card histories in parallel.
+        Yields each card as soon as its initial sprint is known (so not in the order given).
+        Closing the generator early cancels any lookups not yet started.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.history_workers)
+        try:
+            # Copying the context keeps the lookups counted towards the current load
+            futures = [executor.submit(copy_context().run, self.add_initial_sprint, card) for card in cards]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
     def get_card_initial_sprint(self, card_id):
         initial_revision = self.client.get_revisions(card_id, top=1)[0]
         initial_iteration = initial_revision.fields.get('System.IterationPath', None)
@@ -102,7 +351,7 @@ class CardClient:
             sprint = initial_iteration.split("\\")[-1]
             return sprint
         # The card was created in the backlog; check updates
-        # If required for performance, we could batch update retrievals
+        # (sync_history does this for all cards at once)
         # System.IterationLevel2 tracks the sprint level
         updates = self.client.get_updates(card_id)
         for update in updates:
@@ -125,85 +374,414 @@ class CardClient:
         """
         # In case we need to get it again for the relations
         card = self.cache.get_work_item(card.id, expand='relations')
-        if card.id in self.cache.card_parents_cache:
-            # Iterate through cached parents and add them to the card
-            for parent_type, parent_info in self.cache.card_parents_cache[card.id].items():
+        parents = self.cache.get_parents(card)
+        if parents is None:
+            # Not cached, so get info
+            parents = {}
+            current_parent = card
+            while (parent_id :=  current_parent.fields.get('System.Parent')):
+                # Get the parent card
+                current_parent = self.cache.get_work_item(parent_id, expand='relations')
+                # Get the workitem type and title of the parent
+                parent_info = {
+                    'Id': parent_id,
+                    'Title': current_parent.fields['System.Title']
+                }
+                parents[f"Parent {current_parent.fields['System.WorkItemType']}"] = parent_info
+                # If this is the first parent, add it as a direct parent
+                parents.setdefault('Parent', parent_info)
+            self.cache.set_parents(card, parents)
+        # Add the parents as fields
+        for parent_type, parent_info in parents.items():
+            card.fields[parent_type] = parent_info
+        return card
+
+    def add_parents(self, cards):
+        """
+        Add parent fields (Parent, Parent Feature, Parent Epic, ...) to all the given cards at once,
+        as get_card_and_parents does for a single card.
+        Parents are fetched a level of the hierarchy at a time, with one batch request per level,
+        so parents shared between cards are only fetched once.
+        """
+        uncached = [card for card in cards if self.cache.get_parents(card) is None]
+        # Cards in the list can be parents of each other (e.g. a story and its tasks)
+        known = {card.id: card for card in cards}
+        level_ids = {card.fields.get('System.Parent') for card in uncached} - set(known) - {None}
+        while len(level_ids) > 0:
+            level = self.get_cards_batch(level_ids, fields=PARENT_FIELDS)
+            for parent in level:
+                known[parent.id] = parent
+            level_ids = {parent.fields.get('System.Parent') for parent in level} - set(known) - {None}
+        for card in cards:
+            parents = self.cache.get_parents(card)
+            if parents is None:
+                parents = self.walk_parents(card, known)
+                self.cache.set_parents(card, parents)
+            for parent_type, parent_info in parents.items():
                 card.fields[parent_type] = parent_info
-            return card
-        # Not cached, so get info
-        self.cache.card_parents_cache[card.id] = {}
+        return cards
+
+    def walk_parents(self, card, known):
+        """Build the parent fields for a card from already-fetched parent cards."""
+        parents = {}
+        seen = {card.id}
         current_parent = card
-        direct_parent = True
-        while (parent_id :=  current_parent.fields.get('System.Parent')):
-            # Get the parent card
-            current_parent = self.cache.get_work_item(parent_id, expand='relations')
-            # Get the workitem type and title of the parent
-            parent_type = current_parent.fields['System.WorkItemType']
-            parent_title = current_parent.fields['System.Title']
-            # Add the parent as a field
-            card.fields[f'Parent {parent_type}'] = {
-                'Id': parent_id,
-                'Title': parent_title
-            }
-            # Cache the parent info
-            self.cache.card_parents_cache[card.id][f'Parent {parent_type}'] = {
+        while (parent_id := current_parent.fields.get('System.Parent')) and parent_id not in seen:
+            current_parent = known.get(parent_id)
+            if current_parent is None:
+                # Deleted or not visible to us
+                break
+            seen.add(parent_id)
+            parent_info = {
                 'Id': parent_id,
-                'Title': parent_title
+                'Title': current_parent.fields['System.Title']
             }
-            if direct_parent:
-                # If this is the first parent, add it as a direct parent
-                card.fields['Parent'] = {
-                    'Id': parent_id,
-                    'Title': parent_title
-                }
-                self.cache.card_parents_cache[card.id]['Parent'] = {
-                    'Id': parent_id,
-                    'Title': parent_title
-                }
-                direct_parent = False
-        return card
+            parents[f"Parent {current_parent.fields['System.WorkItemType']}"] = parent_info
+            # The first parent is also the direct parent
+            parents.setdefault('Parent', parent_info)
+        return parents
 
 
 class WorkItemCache:
-    def __init__(self, client):
+    def __init__(self, client, disk_cache=None, max_size=20000, card_ttl=3600, request_log=None):
         self.client = client
-        # The cards_cache caches the results of self.client.get_work_item()
-        self.cards_cache = {}
-        # Since we may have multiple "versions" of a card in the cards_cache (different expand or fields),
+        # Optional RequestLog, to record requests the cache saved us
+        self.request_log = request_log
+        # Optional DiskCache, so cached data outlives the session
+        self.disk_cache = disk_cache
+        # The cards_cache holds the work items we've fetched, as {card_id: {(fields, expand): card}}.
+        # A card may be held in several versions (different fields or expand); any version with at least
+        # the requested fields and expansion can answer a request. Indexing by card_id alone means we can
+        # invalidate all versions of a card at once.
+        # Each cache holds at most max_size cards. Cards and their parents' titles expire after card_ttl seconds.
+        # Initial sprints never change, so don't expire; sync_history finds them for every card in the project,
+        # so they aren't bounded either (they are only short strings).
+        self.card_ttl = card_ttl
+        self.cards_cache = LRUCache(max_size, card_ttl)
+        # Since we may have multiple "versions" of a card in the cards_cache,
         # we cache our augmented data separately
-        self.card_parents_cache = {}
+        self.card_parents_cache = LRUCache(max_size, card_ttl)
         self.card_history_cache = {}
+        # Cards being fetched by a batch, as {(card ID, fields, expand): event set when the batch is done}, so an
+        # overlapping batch (e.g. a foreground fetch of the sprint being prefetched) waits for them, not refetches them
+        self.fetching = {}
+        self.fetching_lock = threading.Lock()
+        # Counts of card versions found in the cache, fetched, and dropped from the cache;
+        # updated from several fetch threads, so only under self.cards_cache.lock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Everything cached was up to date as of the watermark (a UTC ISO timestamp)
+        self.watermark = None
+        if self.disk_cache is not None:
+            self.watermark = self.disk_cache.get_meta('watermark')
+        # Cards may have changed while we weren't running, so data from disk needs a refresh before use
+        self.stale = self.watermark is not None
+        if self.watermark is None:
+            self.set_watermark(utc_now())
+        # Where the HistoryFeed has read up to (its continuation token), and the cards created in the backlog
+        # that hadn't been in a sprint as of then
+        self.history_watermark = None
+        self.backlog_ids = set()
+        if self.disk_cache is not None:
+            saved = self.disk_cache.get_meta('history_watermark')
+            saved = json.loads(saved) if saved is not None else None
+            if saved is not None and saved.get('fields') == HISTORY_FIELDS:
+                self.history_watermark = saved['token']
+                self.backlog_ids = set(saved['backlog_ids'])
+            elif saved is not None:
+                # Read for other fields, so without everything the revisions kept now need; the feed starts again
+                self.disk_cache.reset_revisions()
+        # The revisions the HistoryFeed has read, for flow metrics; loaded from disk when first needed
+        self.revision_log = None
+        self.revision_lock = threading.Lock()
+
+    def set_watermark(self, watermark):
+        self.watermark = watermark
+        if self.disk_cache is not None:
+            self.disk_cache.put_meta('watermark', watermark)
+
+    def get_history_watermark(self):
+        """The HistoryFeed watermark, and a copy of the backlog card IDs as of then"""
+        return self.history_watermark, set(self.backlog_ids)
+
+    def set_history_watermark(self, token, backlog_ids):
+        self.history_watermark = token
+        self.backlog_ids = set(backlog_ids)
+        if self.disk_cache is not None:
+            self.disk_cache.put_meta('history_watermark',
+                                     json.dumps({'token': token, 'backlog_ids': sorted(backlog_ids),
+                                                 'fields': HISTORY_FIELDS}))
+
+    def get_revision_log(self):
+        """The RevisionLog of every card revision the HistoryFeed has read"""
+        with self.revision_lock:
+            if self.revision_log is None:
+                rows = self.disk_cache.get_revisions() if self.disk_cache is not None else []
+                self.revision_log = RevisionLog(rows)
+            return self.revision_log
+
+    def add_revisions(self, rows):
+        """Keep card revisions read by the HistoryFeed, as RevisionLog rows (or those the metrics need)"""
+        rows = self.get_revision_log().extend(rows)
+        if self.disk_cache is not None and len(rows) > 0:
+            self.disk_cache.put_revisions(rows)
+
+    def stats(self):
+        with self.cards_cache.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions + self.cards_cache.evictions,
+                    'cards': len(self.cards_cache)}
 
     def reset(self):
-        self.cards_cache = {}
-        self.card_parents_cache = {}
-        self.card_history_cache = {}
+        with self.cards_cache.lock:
+            self.evictions += sum(len(versions) for versions in self.cards_cache.values())
+            self.cards_cache.clear()
+        self.card_parents_cache.clear()
+        self.card_history_cache.clear()
+        if self.disk_cache is not None:
+            self.disk_cache.reset()
+        self.set_watermark(utc_now())
+        # Initial sprints and revisions are all gone, so the HistoryFeed needs to start again
+        with self.revision_lock:
+            self.revision_log = RevisionLog()
+        self.set_history_watermark(None, set())
+
+    def invalidate(self, card_ids):
+        """
+        Drop cached data that may be out of date because the given cards changed:
+        all versions of the cards, their parents, and the parents of any card that has one of them as a parent.
+        Initial sprints are kept, since they can't change.
+        """
+        card_ids = {str(card_id) for card_id in card_ids}
+        for card_id in card_ids:
+            self.drop_work_item(card_id)
+        for card_id, parents in self.card_parents_cache.items():
+            if card_id in card_ids or any(str(parent['Id']) in card_ids for parent in parents.values()):
+                del self.card_parents_cache[card_id]
+        if self.disk_cache is not None:
+            self.disk_cache.invalidate(card_ids)
+
+    def held(self, card_ids):
+        """The IDs of the given cards (as strings) with any version cached, in memory or on disk"""
+        card_ids = {str(card_id) for card_id in card_ids}
+        held = {card_id for card_id in card_ids if self.cards_cache.get(card_id)}
+        if self.disk_cache is not None:
+            held |= self.disk_cache.card_ids_held(card_ids - held, 'item:')
+        return held
+
+    def get_parents(self, card):
+        """Get the cached parent fields of a card, or None"""
+        card_id = str(card.id)
+        if card_id not in self.card_parents_cache and self.disk_fresh():
+            # Parents are only fresh if the card hasn't changed (e.g. been reparented) since
+            parents = self.disk_cache.get(card_id, 'parents', rev=card.rev)
+            if parents is not None:
+                self.card_parents_cache[card_id] = parents
+        return self.card_parents_cache.get(card_id)
 
-    def reset_card(self, card_id):
+    def set_parents(self, card, parents):
+        self.card_parents_cache[str(card.id)] = parents
+        if self.disk_cache is not None:
+            self.disk_cache.put(card.id, 'parents', parents, rev=card.rev,
+                                changed_date=card.fields.get('System.ChangedDate'))
+
+    def get_initial_sprint(self, card_id):
+        """Get the cached initial sprint of a card, or None"""
+        card_id = str(card_id)
+        if card_id not in self.card_history_cache and self.disk_cache is not None:
+            # A card's initial sprint never changes, so any revision will do
+            initial_sprint = self.disk_cache.get(card_id, 'history')
+            if initial_sprint is not None:
+                self.card_history_cache[card_id] = initial_sprint
+        initial_sprint = self.card_history_cache.get(card_id)
+        if initial_sprint is not None and self.request_log is not None:
+            self.request_log.record('wit', 'get_revisions', cached=True)
+        return initial_sprint
+
+    def set_initial_sprint(self, card_id, initial_sprint):
+        self.card_history_cache[str(card_id)] = initial_sprint
+        if self.disk_cache is not None:
+            self.disk_cache.put(card_id, 'history', initial_sprint)
+
+    def set_initial_sprints(self, initial_sprints):
+        """
+        Cache the initial sprints of many cards at once, from {card ID: initial sprint}.
+        Blanks (cards still in the backlog) are left out, as they stop being blank when the card is moved into a sprint.
+        """
+        initial_sprints = {card_id: initial_sprint for card_id, initial_sprint in initial_sprints.items()
+                           if initial_sprint}
+        for card_id, initial_sprint in initial_sprints.items():
+            self.card_history_cache[str(card_id)] = initial_sprint
+        if self.disk_cache is not None and len(initial_sprints) > 0:
+            self.disk_cache.put_all('history', initial_sprints)
+
+    def forget_blank_initial_sprint(self, card_id):
+        """Drop a cached blank initial sprint, e.g. when the card may have been moved out of the backlog"""
         card_id = str(card_id)
-        if card_id in self.cards_cache:
-            del self.cards_cache[card_id]
-        if card_id in self.card_parents_cache:
-            del self.card_parents_cache[card_id]
-        if card_id in self.card_history_cache:
+        if self.card_history_cache.get(card_id) == "":
             del self.card_history_cache[card_id]
+        if self.disk_cache is not None and self.disk_cache.get(card_id, 'history') == "":
+            self.disk_cache.delete(card_id, 'history')
+
+    def drop_work_item(self, card_id):
+        """Drop all versions of a card from the cards_cache"""
+        with self.cards_cache.lock:
+            versions = self.cards_cache.pop(str(card_id), {})
+            self.evictions += len(versions)
+
+    def apply_update(self, updated):
+        """
+        Bring all cached versions of a card up to date with a newer copy of it (e.g. from an update response),
+        keeping what the newer copy doesn't have, such as relations.
+        """
+        if updated.fields.get('System.IterationPath'):
+            # It may have just been moved into its first sprint
+            self.forget_blank_initial_sprint(updated.id)
+        versions = self.cards_cache.get(str(updated.id))
+        if not versions:
+            self.store_work_item(updated)
+            return
+        for (held_fields, held_expand), card in versions.items():
+            for field, value in updated.fields.items():
+                if held_fields is None or field in held_fields:
+                    card.fields[field] = value
+            card.rev = updated.rev
+            self.save_work_item(card, held_fields, held_expand)
+        # Parents are stored against the card revision
+        parents = self.card_parents_cache.get(str(updated.id))
+        if parents is not None:
+            self.set_parents(updated, parents)
+
+    def find_work_item(self, card_id, fields=None, expand=None):
+        """
+        Get a cached version of a card with at least the requested fields and expansion, or None.
+        Falls back to the disk cache, if there is one.
+        """
+        for (held_fields, held_expand), card in self.cards_cache.get(str(card_id), {}).items():
+            if covers(held_fields, held_expand, fields, expand):
+                return card
+        card = self.load_work_item(card_id, fields, expand)
+        if card is not None:
+            self.add_version(card_id, card, fields, expand)
+        return card
+
+    def store_work_item(self, card, fields=None, expand=None):
+        self.add_version(card.id, card, fields, expand)
+        self.save_work_item(card, fields, expand)
+
+    def add_version(self, card_id, card, fields, expand):
+        # A new dict rather than changing the cached one, as other threads may be looking through it;
+        # under the cache's lock, so versions added at the same time aren't lost
+        with self.cards_cache.lock:
+            versions = dict(self.cards_cache.get(str(card_id), {}))
+            versions[fields_key(fields), expand] = card
+            # Setting it again marks it as recently used and restarts its expiry
+            self.cards_cache[str(card_id)] = versions
+
+    def disk_fresh(self):
+        """
+        Whether cards and parents on disk can be used. They are kept up to date by refresh_changed,
+        so are fresh enough unless the last refresh was longer ago than card_ttl.
+        """
+        if self.disk_cache is None:
+            return False
+        if self.card_ttl is None:
+            return True
+        synced = datetime.strptime(self.watermark, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+        # The watermark is backdated by CLOCK_SKEW
+        return datetime.now(timezone.utc) - synced - CLOCK_SKEW < timedelta(seconds=self.card_ttl)
+
+    def load_work_item(self, card_id, fields, expand):
+        """Get a version of a work item from the disk cache, or None"""
+        if not self.disk_fresh():
+            return None
+        data = self.disk_cache.get(card_id, self.disk_kind(fields, expand))
+        if data is None:
+            return None
+        from azure.devops.v7_0.work_item_tracking.models import WorkItem
+        return WorkItem.from_dict(data)
+
+    def save_work_item(self, card, fields, expand):
+        if self.disk_cache is not None:
+            self.disk_cache.put(card.id, self.disk_kind(fields, expand), card.as_dict(), rev=card.rev,
+                                changed_date=card.fields.get('System.ChangedDate'))
+
+    @staticmethod
+    def disk_kind(fields, expand):
+        """The DiskCache kind for a version of a work item"""
+        fields = ','.join(sorted(fields)) if fields else '*'
+        return f"item:{fields}:{expand}"
 
     def get_work_item(self, card_id, expand=None):
-        card_id = str(card_id)
-        # The cache is nested and indexed by just card_id, so we can invalidate all versions of a card when needed
-        if card_id not in self.cards_cache:
-            self.cards_cache[card_id] = {}
-            self.cards_cache[card_id][expand] = self.client.get_work_item(card_id, expand=expand)
-        if expand not in self.cards_cache[card_id]:
-            self.cards_cache[card_id][expand] = self.client.get_work_item(card_id, expand=expand)
-        return self.cards_cache[card_id][expand]
+        card = self.find_work_item(card_id, expand=expand)
+        if card is not None:
+            with self.cards_cache.lock:
+                self.hits += 1
+            if self.request_log is not None:
+                self.request_log.record('wit', 'get_work_item', cached=True)
+            return card
+        with self.cards_cache.lock:
+            self.misses += 1
+        card = self.client.get_work_item(card_id, expand=expand)
+        self.store_work_item(card, expand=expand)
+        return card
 
     # Does not exactly match the API as doesn't require a WorkItemBatchGetRequest
     def get_work_items_batch(self, project, ids, fields=None, expand=None):
-        unknown_ids = [id for id in ids if (id, fields, expand) not in self.cards_cache]
+        found = self.find_work_items(ids, fields, expand)
+        unknown_ids = [id for id in ids if str(id) not in found]
         if len(unknown_ids)>0:
-            request = WorkItemBatchGetRequest(ids=unknown_ids, fields=fields, expand=expand)
-            cards = self.client.get_work_items_batch(request, project=project)
-            for card in cards:
-                self.cards_cache[(card.id, fields, expand)] = card
-        return [self.cards_cache[(id, fields, expand)] for id in ids]
\ No newline at end of file
+            # Fetch the cards no other batch is fetching, then wait for those that one is
+            fetch_key = (tuple(sorted(fields)) if fields else None, expand)
+            done = threading.Event()
+            with self.fetching_lock:
+                waits = {self.fetching[(str(id), fetch_key)] for id in unknown_ids
+                         if (str(id), fetch_key) in self.fetching}
+                claimed_ids = [id for id in unknown_ids if (str(id), fetch_key) not in self.fetching]
+                for id in claimed_ids:
+                    self.fetching[(str(id), fetch_key)] = done
+            try:
+                found.update(self.fetch_work_items(project, claimed_ids, fields, expand))
+            finally:
+                with self.fetching_lock:
+                    for id in claimed_ids:
+                        del self.fetching[(str(id), fetch_key)]
+                done.set()
+            if len(waits) > 0:
+                for event in waits:
+                    event.wait()
+                found.update(self.find_work_items([id for id in unknown_ids if str(id) not in found], fields, expand))
+                # Any the other batch failed to get, we try ourselves
+                found.update(self.fetch_work_items(
+                    project, [id for id in unknown_ids if str(id) not in found and id not in claimed_ids],
+                    fields, expand))
+        # Cards that have been deleted (or we can't see) are left out
+        return [found[str(id)] for id in ids if str(id) in found]
+
+    def find_work_items(self, ids, fields, expand):
+        """The cached versions of the given cards that have the fields and expansion, as {card ID (str): card}"""
+        found = {}
+        for id in ids:
+            card = self.find_work_item(id, fields, expand)
+            if card is not None:
+                found[str(id)] = card
+        with self.cards_cache.lock:
+            self.hits += len(found)
+        if self.request_log is not None and len(found) > 0:
+            self.request_log.record('wit', 'get_work_items_batch', cached=True, items=len(found))
+        return found
+
+    def fetch_work_items(self, project, ids, fields, expand):
+        """Fetch and cache the given cards in one request, returning {card ID (str): card}"""
+        if len(ids) == 0:
+            return {}
+        with self.cards_cache.lock:
+            self.misses += len(ids)
+        from azure.devops.v7_0.work_item_tracking.models import WorkItemBatchGetRequest
+        request = WorkItemBatchGetRequest(ids=ids, fields=fields, expand=expand)
+        cards = self.client.get_work_items_batch(request, project=project)
+        for card in cards:
+            self.store_work_item(card, fields, expand)
+        return {str(card.id): card for card in cards}
+
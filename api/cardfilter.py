@@ -0,0 +1,53 @@
+"""
+Filters on which cards to fetch, which the server applies with a WIQL query
+"""
+
+def wiql_string(value):
+    """A WIQL string literal"""
+    return "'" + value.replace("'", "''") + "'"
+
+def wiql_list(values):
+    return "(" + ", ".join(wiql_string(value) for value in values) + ")"
+
+
+class CardFilter:
+    """
+    Which cards to show: only those in any of states and not in exclude_states, assigned to assigned_to
+    (a display name, or '@Me'), and of any of types. Anything left as None doesn't filter.
+    """
+    def __init__(self, states=None, exclude_states=None, assigned_to=None, types=None):
+        self.states = states
+        self.exclude_states = exclude_states
+        self.assigned_to = assigned_to
+        self.types = types
+
+    def replace(self, **changes):
+        """A copy of this filter with the given changes"""
+        settings = dict(states=self.states, exclude_states=self.exclude_states,
+                        assigned_to=self.assigned_to, types=self.types)
+        settings.update(changes)
+        return CardFilter(**settings)
+
+    def conditions(self):
+        """The WIQL conditions for this filter"""
+        conditions = []
+        if self.states:
+            conditions.append(f"[System.State] IN {wiql_list(self.states)}")
+        if self.exclude_states:
+            conditions.append(f"[System.State] NOT IN {wiql_list(self.exclude_states)}")
+        if self.assigned_to:
+            # Macros like @Me aren't quoted
+            assigned_to = self.assigned_to if self.assigned_to.startswith('@') else wiql_string(self.assigned_to)
+            conditions.append(f"[System.AssignedTo] = {assigned_to}")
+        if self.types:
+            conditions.append(f"[System.WorkItemType] IN {wiql_list(self.types)}")
+        return conditions
+
+    def is_empty(self):
+        return len(self.conditions()) == 0
+
+    def wiql(self, project, iteration_path):
+        """A WIQL query for the IDs of the cards in an iteration that pass this filter"""
+        conditions = [f"[System.TeamProject] = {wiql_string(project)}",
+                      f"[System.IterationPath] = {wiql_string(iteration_path)}"] + self.conditions()
+        return "SELECT [System.Id] FROM WorkItems WHERE " + " AND ".join(conditions)
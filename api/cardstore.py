@@ -0,0 +1,101 @@
+"""
+An in-memory store of the cards we have shown, indexed so lookups and local filtering don't need the API
+"""
+
+class CardRecord:
+    """
+    The displayed details of a card. The card (WorkItem) itself isn't kept, so records stay small;
+    the WorkItemCache (or the panel showing it) has that.
+    """
+    __slots__ = ('id', 'rev', 'type', 'title', 'state', 'assigned', 'parent_id', 'sprint',
+                 'feature_id', 'feature', 'epic_id', 'epic', 'initial_sprint')
+
+    def __init__(self, card):
+        fields = card.fields
+        self.id = card.id
+        self.rev = card.rev
+        self.type = fields.get('System.WorkItemType')
+        self.title = fields.get('System.Title', '')
+        self.state = fields.get('System.State')
+        self.assigned = fields.get('System.AssignedTo', {}).get('displayName')
+        self.parent_id = fields.get('System.Parent')
+        self.sprint = fields.get('System.IterationPath')
+        self.feature_id = fields.get('Parent Feature', {}).get('Id')
+        self.feature = fields.get('Parent Feature', {}).get('Title')
+        self.epic_id = fields.get('Parent Epic', {}).get('Id')
+        self.epic = fields.get('Parent Epic', {}).get('Title')
+        # None until looked up
+        self.initial_sprint = fields.get('Initial Sprint')
+
+
+class CardStore:
+    """
+    CardRecords by card ID, with indexes by sprint (iteration path), parent, Feature, Epic, state, assignee and type.
+    put() keeps the indexes up to date as cards change (e.g. state changes, or moves between sprints),
+    and retain() drops cards that are no longer shown, so the store doesn't grow all session.
+    """
+    # The CardRecord attributes that are indexed, which find() can match on
+    INDEXED = ['sprint', 'parent_id', 'feature_id', 'epic_id', 'state', 'assigned', 'type']
+
+    def __init__(self):
+        self.records = {}
+        # attribute -> value -> set of card IDs
+        self.indexes = {attribute: {} for attribute in self.INDEXED}
+
+    def put(self, card):
+        """Add or update a card, from its WorkItem, and return its record"""
+        record = CardRecord(card)
+        self.remove(record.id)
+        self.records[record.id] = record
+        for attribute, index in self.indexes.items():
+            index.setdefault(getattr(record, attribute), set()).add(record.id)
+        return record
+
+    def put_all(self, cards):
+        return [self.put(card) for card in cards]
+
+    def remove(self, card_id):
+        record = self.records.pop(int(card_id), None)
+        if record is None:
+            return
+        for attribute, index in self.indexes.items():
+            ids = index.get(getattr(record, attribute))
+            ids.discard(record.id)
+            if len(ids) == 0:
+                del index[getattr(record, attribute)]
+
+    def get(self, card_id):
+        """The record for a card ID (int or str), or None"""
+        if card_id is None:
+            return None
+        return self.records.get(int(card_id))
+
+    def __contains__(self, card_id):
+        return self.get(card_id) is not None
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, **conditions):
+        """
+        The IDs of the cards matching all the conditions, each an indexed attribute and the value it must have,
+        e.g. find(sprint=sprint_path, state='Active'). With no conditions, all card IDs.
+        """
+        if len(conditions) == 0:
+            return set(self.records)
+        # Smallest sets first, so the intersections stay small
+        index_sets = sorted((self.indexes[attribute].get(value, set()) for attribute, value in conditions.items()),
+                            key=len)
+        # A copy, so callers can't change the index
+        return index_sets[0].intersection(*index_sets[1:])
+
+    def retain(self, card_ids):
+        """Drop the records of all cards but the given ones (int or str IDs)"""
+        keep = {int(card_id) for card_id in card_ids}
+        for card_id in set(self.records) - keep:
+            self.remove(card_id)
+
+    def clear(self):
+        self.records.clear()
+        for index in self.indexes.values():
+            index.clear()
@@ -0,0 +1,109 @@
+"""
+The connection to Azure DevOps shared by all the API clients
+"""
+
+import threading
+import types
+
+from .instrumentation import InstrumentedClient
+from .scheduler import RequestScheduler, ScheduledClient
+
+class ApiConnection:
+    """
+    One azure.devops Connection for all the API clients, so credentials are set up and resource areas
+    are looked up once, and one pooled keep-alive HTTP session that every client and thread sends through,
+    so parallel fetches reuse open (already TLS-negotiated) sockets rather than opening new ones.
+    Every client's calls go through one RequestScheduler, which prioritises, shares, throttles and retries them.
+    Nothing is imported from the SDK or sent until a client is first used, so the UI can start without waiting.
+    """
+    def __init__(self, base_url, org, token, pool_size=16, timeout=30, request_log=None):
+        self.base_url = base_url
+        self.org = org
+        self.token = token
+        self.pool_size = pool_size
+        # Seconds to wait for each request
+        self.timeout = timeout
+        # Optional RequestLog, which the API clients record their requests in
+        self.request_log = request_log
+        # At most pool_size calls at once, so each has a socket
+        self.scheduler = RequestScheduler(max_concurrency=pool_size)
+        # Set up on first use, by connect()
+        self.connection = None
+        self.session = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Set up the Connection and session, if that hasn't been done yet"""
+        with self.lock:
+            if self.connection is not None:
+                return
+            # Here rather than at the top, as these are slow to import
+            import requests
+            from requests.adapters import HTTPAdapter
+            from azure.devops.connection import Connection
+            from msrest.authentication import BasicAuthentication
+            credentials = BasicAuthentication('', self.token)
+            self.session = requests.Session()
+            # pool_size is the most sockets kept open to a host; it should cover the number of parallel requests
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+            self.session.hooks['response'].append(self.scheduler.on_response)
+            if self.request_log is not None:
+                self.session.hooks['response'].append(self.request_log.on_response)
+            self.connection = Connection(base_url=f"{self.base_url}/{self.org}", creds=credentials)
+
+    def get_work_item_tracking_client(self):
+        def create():
+            self.connect()
+            return self.configure(self.connection.clients.get_work_item_tracking_client())
+        return self.schedule(self.instrument(LazyClient(create), 'wit'), 'wit')
+
+    def get_work_client(self):
+        def create():
+            self.connect()
+            return self.configure(self.connection.clients.get_work_client())
+        return self.schedule(self.instrument(LazyClient(create), 'work'), 'work')
+
+    def schedule(self, client, source):
+        """Send the client's calls through the scheduler (outside any timing, so that only times the requests)"""
+        return ScheduledClient(client, self.scheduler, source)
+
+    def instrument(self, client, source):
+        """Time the client's calls, if we have a RequestLog"""
+        if self.request_log is None:
+            return client
+        return InstrumentedClient(client, self.request_log, source)
+
+    def configure(self, client):
+        """Make an SDK client send its requests through the shared session"""
+        config = client._client.config
+        # Otherwise msrest closes the session (and its sockets) after every request
+        config.keep_alive = True
+        config.connection.timeout = self.timeout
+        driver = config.pipeline._sender.driver
+        # The scheduler retries, so throttling is seen by every thread rather than waited out in one
+        config.retry_policy.retries = 0
+        # Applies msrest's session settings (e.g. retries) to the shared session
+        driver.session = self.session
+        # msrest keeps a session per thread; use the shared one from every thread
+        driver._session_mapping = types.SimpleNamespace(session=self.session)
+        return client
+
+
+class LazyClient:
+    """
+    Stands in for an SDK client, creating it on first use.
+    Creating a client looks up where its API lives, which is a request, so this keeps it off the UI thread.
+    """
+    def __init__(self, create):
+        self.create = create
+        self.client = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self.lock:
+            if self.client is None:
+                self.client = self.create()
+        return getattr(self.client, name)
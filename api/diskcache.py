@@ -0,0 +1,156 @@
+"""
+An on-disk (SQLite) cache of card data, so it survives between abterm sessions
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+def default_cache_path():
+    """The cache file under the user's cache directory (XDG_CACHE_HOME, or ~/.cache)"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'abterm', 'cache.sqlite')
+
+
+class DiskCache:
+    """
+    Stores JSON-serialisable data per card, keyed by organisation, project, card ID and kind
+    (e.g. the card itself, its parents, or its initial sprint).
+    Each entry also records the card revision and changed date it was derived from,
+    so callers can tell whether it is still fresh.
+    """
+    def __init__(self, org, project, path=None):
+        self.org = org
+        self.project = project
+        self.path = path or default_cache_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Shared between the UI thread and fetch workers
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS cards (
+                    org TEXT, project TEXT, card_id TEXT, kind TEXT,
+                    rev INTEGER, changed_date TEXT, data TEXT,
+                    PRIMARY KEY (org, project, card_id, kind)
+                )""")
+            # Anything else we need to remember per project, e.g. when we last synced
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    org TEXT, project TEXT, key TEXT, value TEXT,
+                    PRIMARY KEY (org, project, key)
+                )""")
+            # Every revision of every card, as far as flow metrics need; time is seconds since the epoch
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS revisions (
+                    org TEXT, project TEXT, card_id INTEGER, rev INTEGER,
+                    time REAL, type TEXT, state TEXT, iteration TEXT,
+                    PRIMARY KEY (org, project, card_id, rev)
+                )""")
+
+    def get(self, card_id, kind, rev=None):
+        """
+        Get cached data for a card, or None if there is none.
+        If rev is given, data derived from any other revision of the card counts as missing.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT rev, data FROM cards WHERE org=? AND project=? AND card_id=? AND kind=?",
+                (self.org, self.project, str(card_id), kind)).fetchone()
+        if row is None:
+            return None
+        cached_rev, data = row
+        if rev is not None and cached_rev != rev:
+            return None
+        return json.loads(data)
+
+    def card_ids_held(self, card_ids, kind_prefix):
+        """The IDs of the given cards (as strings) with data of a kind starting with kind_prefix"""
+        card_ids = [str(card_id) for card_id in card_ids]
+        held = set()
+        with self.lock:
+            # SQLite limits the number of parameters in a query
+            for start in range(0, len(card_ids), 500):
+                batch = card_ids[start:start+500]
+                rows = self.db.execute(
+                    f"SELECT DISTINCT card_id FROM cards WHERE org=? AND project=? AND kind LIKE ? "
+                    f"AND card_id IN ({','.join('?' * len(batch))})",
+                    (self.org, self.project, kind_prefix + '%', *batch)).fetchall()
+                held.update(card_id for card_id, in rows)
+        return held
+
+    def put(self, card_id, kind, data, rev=None, changed_date=None):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.org, self.project, str(card_id), kind, rev, changed_date,
+                 json.dumps(data, default=str)))
+
+    def delete(self, card_id, kind):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM cards WHERE org=? AND project=? AND card_id=? AND kind=?",
+                            (self.org, self.project, str(card_id), kind))
+
+    def put_all(self, kind, data_by_card_id):
+        """Store data of one kind for many cards at once (without revisions), in one transaction"""
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(self.org, self.project, str(card_id), kind, None, None, json.dumps(data, default=str))
+                 for card_id, data in data_by_card_id.items()])
+
+    def put_revisions(self, rows):
+        """Store card revisions, as (card ID, revision number, time, type, state, iteration path) rows"""
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(self.org, self.project) + tuple(row) for row in rows])
+
+    def get_revisions(self):
+        """All the stored card revisions, as put_revisions takes them, in the order they were stored"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT card_id, rev, time, type, state, iteration FROM revisions WHERE org=? AND project=? "
+                "ORDER BY rowid", (self.org, self.project)).fetchall()
+
+    def reset_revisions(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM revisions WHERE org=? AND project=?", (self.org, self.project))
+
+    def invalidate(self, card_ids):
+        """
+        Drop cached data that may be out of date because the given cards changed:
+        the cards themselves and their parents, and the parents of any card that has one of them as a parent.
+        Initial sprints are kept, since they can't change.
+        """
+        card_ids = {str(card_id) for card_id in card_ids}
+        with self.lock, self.db:
+            rows = self.db.execute(
+                "SELECT card_id, data FROM cards WHERE org=? AND project=? AND kind='parents'",
+                (self.org, self.project)).fetchall()
+            dependents = {card_id for card_id, data in rows
+                          if any(str(parent['Id']) in card_ids for parent in json.loads(data).values())}
+            for card_id in card_ids:
+                self.db.execute("DELETE FROM cards WHERE org=? AND project=? AND card_id=? AND kind!='history'",
+                                (self.org, self.project, card_id))
+            for card_id in dependents:
+                self.db.execute("DELETE FROM cards WHERE org=? AND project=? AND card_id=? AND kind='parents'",
+                                (self.org, self.project, card_id))
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE org=? AND project=? AND key=?",
+                                  (self.org, self.project, key)).fetchone()
+        return None if row is None else row[0]
+
+    def put_meta(self, key, value):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?)",
+                            (self.org, self.project, key, value))
+
+    def reset(self):
+        """Drop everything cached for this organisation and project"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM cards WHERE org=? AND project=?", (self.org, self.project))
+            self.db.execute("DELETE FROM revisions WHERE org=? AND project=?", (self.org, self.project))
@@ -0,0 +1,104 @@
+"""
+Exports the cards of sprints, with the same details the cards table shows, for scripts and dashboards
+"""
+
+import csv
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+
+from .cardclient import BATCH_SIZE, CARD_FIELDS
+
+# The fields of each exported card, in order
+EXPORT_FIELDS = ['sprint', 'id', 'type', 'title', 'state', 'assigned', 'feature_id', 'feature',
+                 'epic_id', 'epic', 'parent_id', 'initial_sprint', 'rev', 'changed_date']
+
+def card_record(card, sprint):
+    """A flat dict of a card's details (including those add_parents and add_initial_sprint add), in EXPORT_FIELDS"""
+    fields = card.fields
+    return {
+        'sprint': sprint.name,
+        'id': card.id,
+        'type': fields.get('System.WorkItemType'),
+        'title': fields.get('System.Title'),
+        'state': fields.get('System.State'),
+        'assigned': fields.get('System.AssignedTo', {}).get('displayName'),
+        'feature_id': fields.get('Parent Feature', {}).get('Id'),
+        'feature': fields.get('Parent Feature', {}).get('Title'),
+        'epic_id': fields.get('Parent Epic', {}).get('Id'),
+        'epic': fields.get('Parent Epic', {}).get('Title'),
+        'parent_id': fields.get('System.Parent'),
+        'initial_sprint': fields.get('Initial Sprint'),
+        'rev': card.rev,
+        'changed_date': fields.get('System.ChangedDate'),
+    }
+
+
+class JsonLinesWriter:
+    """Writes each record as a line of JSON, as soon as it is given, from any thread"""
+    def __init__(self, file, fields=None):
+        # fields are taken for the same signature as CsvWriter; each record is written with all its fields
+        self.file = file
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+class CsvWriter:
+    """Writes each record as a CSV row (after a header row), as soon as it is given, from any thread"""
+    def __init__(self, file, fields=EXPORT_FIELDS):
+        self.file = file
+        self.lock = threading.Lock()
+        self.writer = csv.DictWriter(file, fieldnames=fields)
+        self.writer.writeheader()
+
+    def write(self, record):
+        with self.lock:
+            self.writer.writerow(record)
+            self.file.flush()
+
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+}
+
+
+class SprintExporter:
+    """
+    Streams the cards of several sprints to a writer, up to sprint_workers sprints at once.
+    Each sprint's cards are fetched a batch at a time, and each card is written as soon as its details are complete,
+    so output starts before everything is fetched. Rows from different sprints are interleaved.
+    """
+    def __init__(self, card_client, sprint_client, sprint_workers=4, card_filter=None):
+        self.card_client = card_client
+        self.sprint_client = sprint_client
+        self.sprint_workers = sprint_workers
+        # Optional CardFilter, for which cards to export
+        self.card_filter = card_filter
+
+    def export(self, sprints, writer):
+        """Export the given sprints, returning {sprint name: exception} for any that failed"""
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.sprint_workers) as executor:
+            futures = {executor.submit(copy_context().run, self.export_sprint, sprint, writer): sprint
+                       for sprint in sprints}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[futures[future].name] = e
+        return failed
+
+    def export_sprint(self, sprint, writer):
+        card_ids = self.card_client.get_sprint_card_ids(sprint.id, self.sprint_client, self.card_filter)
+        for start in range(0, len(card_ids), BATCH_SIZE):
+            # The fields card_record needs, which are the ones the cards table is built from
+            cards = self.card_client.get_cards_batch(card_ids[start:start+BATCH_SIZE], fields=CARD_FIELDS)
+            cards = self.card_client.add_parents(cards)
+            for card in self.card_client.iter_initial_sprints(cards):
+                writer.write(card_record(card, sprint))
@@ -0,0 +1,266 @@
+"""
+Sprint velocity and flow metrics (carry-over, completion, cycle time and cumulative flow), worked out from the card
+revisions the HistoryFeed caches, without making any requests
+"""
+
+import math
+import statistics
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+from itertools import compress
+
+# States in which a card counts as done
+DONE_STATES = ['Development Completed', 'Ready for UAT', 'Closed', 'Removed']
+
+# States in which work on a card hasn't started; its cycle time runs from leaving these to reaching a done state
+NEW_STATES = ['New']
+
+DAY = 24 * 60 * 60
+
+# The fields of each row of sprint metrics, in order
+SPRINT_METRIC_FIELDS = ['sprint', 'start_date', 'finish_date', 'committed', 'added', 'completed', 'carried_in',
+                        'carried_over', 'open', 'completion_rate', 'cycle_time_median', 'cycle_time_85th']
+
+# The fields of each row of cumulative flow data: the number of cards in a state at the end of a day
+FLOW_FIELDS = ['date', 'state', 'cards']
+
+def parse_time(value):
+    """Seconds since the epoch of an ISO timestamp (as the API returns them) or a datetime; None for None"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def format_date(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%d')
+
+
+class RevisionLog:
+    """
+    The revisions of cards that flow metrics need, held a column per field, so they take little memory
+    and can be swept through quickly: card IDs, times (seconds since the epoch), and codes standing for
+    work item types, states and iteration paths (see self.values).
+    Revisions that change none of these (most edits, e.g. of titles) are left out, as the metrics don't need them.
+    Only ever appended to, so readers can work on a snapshot while the HistoryFeed adds more.
+    """
+    def __init__(self, rows=()):
+        self.card_ids = array('q')
+        self.times = array('d')
+        self.types = array('l')
+        self.states = array('l')
+        self.iterations = array('l')
+        # Strings by code, and codes by string
+        self.values = []
+        self.codes = {}
+        # The codes of each card's type, state and iteration path as of its latest revision kept
+        self.latest = {}
+        self.lock = threading.Lock()
+        # The length as of the last sort, and the positions of the revisions (up to that length) in time order
+        self.order = (0, [])
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self.card_ids)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def extend(self, rows):
+        """
+        Add revisions, as (card ID, revision number, time, type, state, iteration path) rows, each card's in order.
+        Returns the rows kept.
+        """
+        kept = []
+        with self.lock:
+            for row in rows:
+                card_id, _, changed, card_type, state, iteration = row
+                codes = (self.code(card_type), self.code(state), self.code(iteration))
+                if self.latest.get(card_id) == codes:
+                    continue
+                self.latest[card_id] = codes
+                kept.append(row)
+                self.card_ids.append(card_id)
+                self.times.append(changed)
+                self.types.append(codes[0])
+                self.states.append(codes[1])
+                self.iterations.append(codes[2])
+        return kept
+
+    def snapshot(self):
+        """The number of revisions so far, and their positions in time order"""
+        with self.lock:
+            length, order = self.order
+            if length != len(self.card_ids):
+                length = len(self.card_ids)
+                # The feed is mostly in time order, which sorting is quick for
+                order = sorted(range(length), key=self.times.__getitem__)
+                self.order = (length, order)
+            return length, order
+
+
+class FlowMetrics:
+    """
+    Metrics for sprints (objects with name, path and attributes.start_date and finish_date, as SprintClient gives;
+    those without dates are left out), from one pass through a RevisionLog in time order. For each sprint:
+    - committed: cards in it as it started; added: cards moved (or created) into it after that, before it finished
+    - completed: cards that first reached one of done_states while in it
+    - carried_in: cards moved into it from an earlier sprint; carried_over: cards moved from it to a later sprint
+      before they were done (the rollover the Initial column shows card by card)
+    - open: cards in it that aren't done, as of the last revision
+    - completion_rate: completed as a fraction of committed plus added
+    - cycle_time_median and cycle_time_85th: in days, from leaving new_states to being done, for the cards it completed
+    The cumulative flow is how many of the sprints' cards (cards that were ever in one) were in each state at the
+    end of each day, from the first sprint's start to the last one's finish (or today).
+    types, if given, are the only work item types counted.
+    """
+    def __init__(self, sprints, done_states=DONE_STATES, new_states=NEW_STATES, types=None):
+        dated = [sprint for sprint in sprints if sprint.attributes is not None
+                 and getattr(sprint.attributes, 'start_date', None) is not None
+                 and getattr(sprint.attributes, 'finish_date', None) is not None]
+        self.sprints = sorted(dated, key=lambda sprint: parse_time(sprint.attributes.start_date))
+        self.starts = [parse_time(sprint.attributes.start_date) for sprint in self.sprints]
+        # Finish dates are the sprints' last days
+        self.ends = [parse_time(sprint.attributes.finish_date) + DAY for sprint in self.sprints]
+        self.done_states = done_states
+        self.new_states = new_states
+        self.types = types
+
+    def compute(self, log, now=None):
+        """Returns (a row per sprint, in SPRINT_METRIC_FIELDS; cumulative flow rows, in FLOW_FIELDS)"""
+        now = time.time() if now is None else now
+        length, order = log.snapshot()
+        codes = log.codes
+        # Lists by code are quicker to look in than dicts
+        sprint_for_code = [-1] * len(log.values)
+        for index, sprint in enumerate(self.sprints):
+            if sprint.path in codes:
+                sprint_for_code[codes[sprint.path]] = index
+        done = {codes[state] for state in self.done_states if state in codes}
+        new = {codes[state] for state in self.new_states if state in codes}
+        card_ids, times, states, iterations = log.card_ids, log.times, log.states, log.iterations
+
+        # Whole columns at a time: the cards that were ever in one of the sprints (and are of the given types),
+        # then the positions of their revisions in time order, then the columns in that order
+        in_sprints = map((-1).__ne__, map(sprint_for_code.__getitem__, iterations[:length]))
+        if self.types is not None:
+            type_codes = {codes[card_type] for card_type in self.types if card_type in codes}
+            in_sprints = map(bool.__and__, in_sprints, map(type_codes.__contains__, log.types[:length]))
+        counted_ids = set(compress(card_ids[:length], in_sprints))
+        positions = list(compress(order, map(counted_ids.__contains__, map(card_ids.__getitem__, order))))
+        revisions = zip(map(times.__getitem__, positions), map(card_ids.__getitem__, positions),
+                        map(sprint_for_code.__getitem__, map(iterations.__getitem__, positions)),
+                        map(states.__getitem__, positions))
+
+        count = len(self.sprints)
+        committed = [None] * count
+        added = [0] * count
+        completed = [0] * count
+        carried_in = [0] * count
+        carried_over = [0] * count
+        cycle_times = [[] for _ in range(count)]
+        cards_in = [0] * count
+        # Where each card is up to: (its sprint, -1 for none of them; its state), and when it was started
+        where = {}
+        nowhere = (-1, None)
+        started_at = {}
+        completed_ids = set()
+        entered = set()
+        # Cards in each state (by code), and the flow rows
+        state_counts = [0] * len(log.values)
+        flow = []
+
+        # The times of sprint starts (for committed) and day ends (for the flow), in order
+        boundaries = [(start, index) for index, start in enumerate(self.starts)]
+        if count > 0:
+            first_day = self.starts[0] - self.starts[0] % DAY
+            last_day = min(max(self.ends), now)
+            boundaries += [(day, None) for day in range(int(first_day) + DAY, int(last_day) + DAY, DAY)]
+        boundaries.sort(key=lambda boundary: boundary[0])
+        boundaries.append((math.inf, None))
+        next_boundary = 0
+
+        def pass_boundaries(changed):
+            """Note everything due at boundaries up to changed. Cards moved in as a sprint starts count as committed."""
+            nonlocal next_boundary
+            while True:
+                boundary, index = boundaries[next_boundary]
+                if boundary > changed or (boundary == changed and index is not None):
+                    return boundary
+                next_boundary += 1
+                if index is not None:
+                    committed[index] = cards_in[index]
+                    continue
+                date = format_date(boundary - DAY)
+                flow.extend({'date': date, 'state': log.values[state], 'cards': cards}
+                            for state, cards in enumerate(state_counts) if cards > 0)
+
+        next_time = pass_boundaries(-math.inf)
+        for changed, card_id, sprint, state in revisions:
+            if changed >= next_time:
+                next_time = pass_boundaries(changed)
+            old_sprint, old_state = where.get(card_id, nowhere)
+            if sprint == old_sprint and state == old_state:
+                continue
+            where[card_id] = (sprint, state)
+            if sprint != old_sprint:
+                if old_sprint >= 0:
+                    cards_in[old_sprint] -= 1
+                if sprint >= 0:
+                    cards_in[sprint] += 1
+                    if (card_id, sprint) not in entered:
+                        entered.add((card_id, sprint))
+                        if self.starts[sprint] < changed < self.ends[sprint]:
+                            added[sprint] += 1
+                if 0 <= old_sprint < sprint:
+                    carried_in[sprint] += 1
+                    if old_state not in done:
+                        carried_over[old_sprint] += 1
+            if state != old_state:
+                state_counts[state] += 1
+                if old_state is not None:
+                    state_counts[old_state] -= 1
+                if state in done:
+                    if card_id not in completed_ids and sprint >= 0:
+                        completed_ids.add(card_id)
+                        completed[sprint] += 1
+                        if card_id in started_at:
+                            cycle_times[sprint].append((changed - started_at[card_id]) / DAY)
+                elif state not in new and card_id not in started_at:
+                    started_at[card_id] = changed
+        # Up to now, not the last revision, so sprints and days since are covered
+        pass_boundaries(now)
+
+        open_cards = [0] * count
+        for sprint, state in where.values():
+            if sprint >= 0 and state not in done:
+                open_cards[sprint] += 1
+        rows = []
+        for index, sprint in enumerate(self.sprints):
+            planned = (committed[index] or 0) + added[index]
+            times_taken = sorted(cycle_times[index])
+            rows.append({
+                'sprint': sprint.name,
+                'start_date': format_date(self.starts[index]),
+                'finish_date': format_date(self.ends[index] - DAY),
+                'committed': committed[index],
+                'added': added[index],
+                'completed': completed[index],
+                'carried_in': carried_in[index],
+                'carried_over': carried_over[index],
+                'open': open_cards[index],
+                'completion_rate': round(completed[index] / planned, 2) if planned else None,
+                'cycle_time_median': round(statistics.median(times_taken), 1) if times_taken else None,
+                # Nearest rank
+                'cycle_time_85th': round(times_taken[math.ceil(0.85 * len(times_taken)) - 1], 1)
+                                   if times_taken else None,
+            })
+        return rows, flow
@@ -0,0 +1,104 @@
+"""
+Works out initial sprints for a whole project at once, from the work item reporting revisions feed
+"""
+
+import threading
+
+from .flowmetrics import parse_time
+
+# The only fields the feed needs to return to tell a card's initial sprint, and to follow its sprint and state over
+# time for flow metrics
+HISTORY_FIELDS = ['System.IterationPath', 'System.IterationLevel2', 'System.State', 'System.WorkItemType',
+                  'System.ChangedDate']
+
+# Most revisions to ask for in each page of the feed
+HISTORY_PAGE_SIZE = 1000
+
+def batch_value(batch, attribute, key):
+    """
+    An attribute of a page of the feed. The SDK's ReportingWorkItemRevisionsBatch model declares no attributes,
+    so the SDK leaves everything in additional_properties, under the JSON key.
+    """
+    value = getattr(batch, attribute, None)
+    if value is None:
+        value = (getattr(batch, 'additional_properties', None) or {}).get(key)
+    return value
+
+def revision_row(revision):
+    """A revision from the feed as a RevisionLog row, or None if it doesn't say when it was made"""
+    fields = revision.get('fields') or {}
+    changed = parse_time(fields.get('System.ChangedDate'))
+    if changed is None:
+        return None
+    return (revision['id'], revision.get('rev'), changed, fields.get('System.WorkItemType'),
+            fields.get('System.State'), fields.get('System.IterationPath'))
+
+
+class HistoryFeed:
+    """
+    Finds the initial sprint of every card in a project from the reporting revisions feed, which returns a page of
+    revisions of any number of cards per request, rather than looking up each card's history separately.
+    Only the iteration, state and type fields are fetched. A card's initial sprint is the sprint it was created in,
+    or if it was created in the backlog, the sprint it was first moved into (which a later sync may find).
+    The feed's continuation token is kept in the WorkItemCache as a watermark, so later syncs (including in later
+    sessions, with the disk cache) only read the revisions made since.
+    The revisions themselves are also kept, in the WorkItemCache's RevisionLog, for flow metrics.
+    """
+    def __init__(self, client, project, cache, page_size=HISTORY_PAGE_SIZE):
+        self.client = client
+        self.project = project
+        # The WorkItemCache, which holds the initial sprints found and the watermark
+        self.cache = cache
+        self.page_size = page_size
+        # One sync at a time, as each carries on from where the last left off
+        self.lock = threading.Lock()
+
+    def sync(self, is_cancelled=lambda: False):
+        """
+        Read the feed from the watermark to the end, caching the initial sprints found.
+        Returns how many cards were found to have an initial sprint. If cancelled, stops after the current page.
+        """
+        with self.lock:
+            token, backlog_ids = self.cache.get_history_watermark()
+            found = 0
+            while True:
+                batch = self.client.read_reporting_revisions_get(project=self.project, fields=HISTORY_FIELDS,
+                                                                 continuation_token=token,
+                                                                 max_page_size=self.page_size)
+                initial_sprints = {}
+                rows = []
+                for revision in batch_value(batch, 'values', 'values') or []:
+                    self.apply(revision, backlog_ids, initial_sprints)
+                    rows.append(revision_row(revision))
+                found += sum(1 for sprint in initial_sprints.values() if sprint)
+                token = batch_value(batch, 'continuation_token', 'continuationToken') or token
+                # Saved with the watermark, so a sync stopped part way can carry on from there
+                self.cache.add_revisions([row for row in rows if row is not None])
+                self.cache.set_initial_sprints(initial_sprints)
+                self.cache.set_history_watermark(token, backlog_ids)
+                if batch_value(batch, 'is_last_batch', 'isLastBatch') is not False or is_cancelled():
+                    return found
+
+    def apply(self, revision, backlog_ids, initial_sprints):
+        """
+        Take account of a revision of a card (a dict, as the feed returns them), adding any initial sprint it gives
+        to initial_sprints. backlog_ids are the cards created in the backlog and not yet in a sprint.
+        """
+        card_id = revision['id']
+        fields = revision.get('fields') or {}
+        if revision.get('rev') == 1:
+            iteration = fields.get('System.IterationPath')
+            if iteration and "\\" in iteration:
+                # Created in a sprint
+                initial_sprints[card_id] = iteration.split("\\")[-1]
+                return
+            if iteration:
+                backlog_ids.add(card_id)
+            # Blank, unless the card is later moved into a sprint
+            initial_sprints[card_id] = ""
+            return
+        # System.IterationLevel2 tracks the sprint level
+        sprint = fields.get('System.IterationLevel2')
+        if card_id in backlog_ids and sprint:
+            backlog_ids.discard(card_id)
+            initial_sprints[card_id] = sprint
@@ -0,0 +1,127 @@
+"""
+Timing of the requests we make to Azure DevOps, to find out what makes loading slow
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# The LoadStats that requests made in this context count towards, e.g. the sprint being loaded.
+# Thread pools don't pass contexts on by themselves; see copy_context() where we submit work.
+current_load = ContextVar('current_load', default=None)
+
+# Bytes received by this thread since it last started a request
+response_sizes = threading.local()
+
+
+class LoadStats:
+    """Totals for a group of requests, e.g. everything done to load one sprint"""
+    def __init__(self, label, background=False):
+        self.label = label
+        # Whether the user isn't waiting for it, e.g. prefetching
+        self.background = background
+        self.started = time.time()
+        self.finished = None
+        self.requests = 0
+        self.cached = 0
+        self.latency = 0.0
+        self.bytes = 0
+        # method -> [requests, cached, latency, bytes]
+        self.by_method = {}
+
+    def add(self, entry):
+        method = self.by_method.setdefault(entry['method'], [0, 0, 0.0, 0])
+        if entry['cached']:
+            self.cached += entry['items']
+            method[1] += entry['items']
+        else:
+            self.requests += 1
+            self.latency += entry['latency']
+            self.bytes += entry['bytes']
+            method[0] += 1
+            method[2] += entry['latency']
+            method[3] += entry['bytes']
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+
+class RequestLog:
+    """
+    Records every request made through an InstrumentedClient, and every item a cache served instead.
+    Keeps totals for the whole session and for each load, and optionally writes each record
+    to a trace file as a line of JSON.
+    """
+    def __init__(self, trace_path=None):
+        self.lock = threading.Lock()
+        self.totals = LoadStats('session')
+        # Most recent last
+        self.loads = []
+        self.trace_file = open(trace_path, 'a') if trace_path else None
+
+    @contextmanager
+    def load(self, label, background=False):
+        """Count requests made within the block (including by thread pools it starts) towards a new load"""
+        stats = LoadStats(label, background)
+        with self.lock:
+            self.loads = self.loads[-49:] + [stats]
+        token = current_load.set(stats)
+        try:
+            yield stats
+        finally:
+            stats.finished = time.time()
+            current_load.reset(token)
+
+    def latest_load(self, background=False):
+        with self.lock:
+            for stats in reversed(self.loads):
+                if stats.background == background:
+                    return stats
+        return None
+
+    def record(self, source, method, latency=0.0, size=0, cached=False, items=1):
+        load = current_load.get()
+        entry = {
+            'time': time.time(),
+            'load': load.label if load is not None else None,
+            'source': source,
+            'method': method,
+            'latency': round(latency, 4),
+            'bytes': size,
+            'cached': cached,
+            'items': items,
+        }
+        with self.lock:
+            self.totals.add(entry)
+            if load is not None:
+                load.add(entry)
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(entry) + '\n')
+                self.trace_file.flush()
+
+    def on_response(self, response, *args, **kwargs):
+        """requests response hook, counting the size of each response body"""
+        response_sizes.total = getattr(response_sizes, 'total', 0) + len(response.content)
+
+
+class InstrumentedClient:
+    """Wraps an SDK client, timing every method call and recording it in a RequestLog"""
+    def __init__(self, client, request_log, source):
+        self.client = client
+        self.request_log = request_log
+        self.source = source
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def timed(*args, **kwargs):
+            response_sizes.total = 0
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.request_log.record(self.source, name, time.perf_counter() - start, response_sizes.total)
+        return timed
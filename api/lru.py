@@ -0,0 +1,91 @@
+"""
+A size-bounded, optionally expiring, dict-like cache
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+class LRUCache:
+    """
+    Holds at most max_size entries, dropping the least recently used when full.
+    If ttl (in seconds) is given, entries also expire that long after they were stored.
+    Supports the parts of the dict interface the API caches use.
+    """
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (time stored, value), least recently used first
+        self.entries = OrderedDict()
+        # Shared between the UI thread and fetch workers
+        self.lock = threading.RLock()
+        # Count of entries dropped for being too old or least recently used
+        self.evictions = 0
+
+    def expired(self, stored_at):
+        return self.ttl is not None and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if self.expired(entry[0]):
+                del self.entries[key]
+                self.evictions += 1
+                return default
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while self.max_size is not None and len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.entries[key]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.get(key, MISSING)
+            if value is MISSING:
+                return default
+            del self.entries[key]
+            return value
+
+    def items(self):
+        """The unexpired entries, as a list (so the cache can be changed while iterating)"""
+        with self.lock:
+            return [(key, value) for key, (stored_at, value) in self.entries.items()
+                    if not self.expired(stored_at)]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def __len__(self):
+        """The number of unexpired entries; expired ones are dropped"""
+        with self.lock:
+            expired = [key for key, (stored_at, _) in self.entries.items() if self.expired(stored_at)]
+            for key in expired:
+                del self.entries[key]
+            self.evictions += len(expired)
+            return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
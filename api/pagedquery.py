@@ -0,0 +1,83 @@
+"""
+WIQL queries run a page at a time, so they can find more than the 20,000 work items one WIQL query may return
+"""
+
+from .cardfilter import wiql_string
+
+# Most work items a WIQL query may return; a query that would return more fails
+WIQL_LIMIT = 20000
+
+def is_over_limit(error):
+    """Whether an SDK exception came from a query that would return more than WIQL_LIMIT items"""
+    # VS402337 is the server's error code for this
+    return 'VS402337' in str(error)
+
+
+class PagedQuery:
+    """
+    The IDs of the work items in project matching WIQL conditions, a page at a time, in ID order.
+    Each page asks for the next page_size IDs after the last one seen, so no query returns more than page_size.
+    If the server still refuses a page as too big, pages are narrowed to spans of IDs, halving until they fit.
+    """
+    def __init__(self, client, project, conditions, page_size=5000, time_precision=None):
+        self.client = client
+        self.project = project
+        self.conditions = conditions
+        self.page_size = min(page_size, WIQL_LIMIT)
+        # Needed for ChangedDate conditions to compare times rather than just dates
+        self.time_precision = time_precision
+
+    def wiql(self, after=None, upto=None, descending=False):
+        """A WIQL query for IDs after after and up to upto (either None meaning no bound)"""
+        conditions = [f"[System.TeamProject] = {wiql_string(self.project)}"] + list(self.conditions)
+        if after is not None:
+            conditions.append(f"[System.Id] > {after}")
+        if upto is not None:
+            conditions.append(f"[System.Id] <= {upto}")
+        order = "DESC" if descending else "ASC"
+        return f"SELECT [System.Id] FROM WorkItems WHERE {' AND '.join(conditions)} ORDER BY [System.Id] {order}"
+
+    def query(self, wiql, top):
+        from azure.devops.v7_0.work_item_tracking.models import Wiql
+        listing = self.client.query_by_wiql(Wiql(wiql), time_precision=self.time_precision, top=top)
+        return [item.id for item in listing.work_items]
+
+    def pages(self):
+        """Yield lists of IDs, until there are no more. Stops early if the caller stops iterating."""
+        after = None
+        while True:
+            try:
+                page = self.query(self.wiql(after), self.page_size)
+            except Exception as e:
+                if not is_over_limit(e):
+                    raise
+                yield from self.spans(after)
+                return
+            if len(page) > 0:
+                yield page
+            if len(page) < self.page_size:
+                return
+            after = page[-1]
+
+    def spans(self, after):
+        """Yield the IDs after after a span of IDs at a time, for when even a page of them is refused"""
+        last = self.query(self.wiql(descending=True), 1)
+        if len(last) == 0:
+            return
+        after = after or 0
+        span = self.page_size
+        while after < last[0]:
+            try:
+                page = self.query(self.wiql(after, after + span), None)
+            except Exception as e:
+                if not is_over_limit(e) or span == 1:
+                    raise
+                span //= 2
+                continue
+            if len(page) > 0:
+                yield page
+            after += span
+
+    def ids(self):
+        """All the matching IDs, in ID order"""
+        return [card_id for page in self.pages() for card_id in page]
@@ -0,0 +1,211 @@
+"""
+The one place every Azure DevOps API call goes through, so they can be prioritised, shared, throttled and retried
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .backoff import is_throttled, is_transient, retry_delay
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# The priority of calls made in the current context (thread, or copied context in a pool)
+request_priority = ContextVar('request_priority', default=INTERACTIVE)
+
+# The status and Retry-After of the last response each thread received, as the SDK's exceptions don't keep them
+last_response = threading.local()
+
+# Only calls that read are shared between callers
+SHARED_PREFIXES = ('get_', 'query_', 'read_')
+
+@contextmanager
+def background_priority():
+    """Make API calls in this context wait for any interactive ones, e.g. for prefetching"""
+    token = request_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+def call_key(source, name, args, kwargs):
+    """What identifies a call, so identical concurrent calls can share one request, or None if it can't be shared"""
+    if not name.startswith(SHARED_PREFIXES):
+        return None
+    key = (source, name, args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        # e.g. batch requests, which take SDK models; WorkItemCache.get_work_items_batch shares those card by card
+        return None
+    return key
+
+
+class RequestScheduler:
+    """
+    Runs API calls for any number of threads, at most self.concurrency at once:
+    - Interactive calls go first; background calls only start while no interactive call is waiting.
+    - Identical read calls made while one is in flight (e.g. two lookups of the same work item) wait for it
+      and share its result, rather than making another request.
+    - Throttling pauses every call: a Retry-After header (or a 429) pauses for that long and halves the concurrency,
+      as does X-RateLimit-Remaining running low or an X-RateLimit-Delay. The concurrency then grows back by one
+      for each self.concurrency calls that succeed (so it adapts to what the server allows).
+    - Transient failures (throttling, timeouts, 5xx, dropped connections) are retried, up to retries times in all,
+      with exponential backoff unless the server says how long to wait.
+    """
+    def __init__(self, max_concurrency=16, retries=5, delay=1.0):
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.retries = retries
+        # Seconds before the first retry, doubling for each retry after
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting_interactive = 0
+        # No calls start before this time.monotonic() time
+        self.paused_until = 0.0
+        # When we last slowed down
+        self.backed_off_at = 0.0
+        # Successful calls since the concurrency last changed
+        self.successes = 0
+        # call_key -> Future for calls in flight
+        self.in_flight = {}
+        # Counts of calls shared, retried, and of times we were throttled
+        self.shared = 0
+        self.retried = 0
+        self.throttled = 0
+
+    def call(self, source, name, func, *args, **kwargs):
+        """Call func(*args, **kwargs), which makes the API call source.name, when the scheduler allows"""
+        key = call_key(source, name, args, kwargs)
+        if key is None:
+            return self.call_with_retries(func, *args, **kwargs)
+        with self.condition:
+            shared = self.in_flight.get(key)
+            if shared is None:
+                self.in_flight[key] = future = Future()
+            else:
+                self.shared += 1
+        if shared is not None:
+            return shared.result()
+        try:
+            result = self.call_with_retries(func, *args, **kwargs)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.condition:
+                del self.in_flight[key]
+
+    def call_with_retries(self, func, *args, **kwargs):
+        for attempt in range(self.retries):
+            last_response.status = None
+            last_response.retry_after = None
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                status = last_response.status
+                if not is_transient(e, status) or attempt == self.retries - 1:
+                    raise
+                wait = retry_delay(attempt, self.delay, last_response.retry_after)
+                if is_throttled(e, status) and last_response.retry_after is None:
+                    # Otherwise on_response has already backed off
+                    self.back_off(wait)
+                with self.condition:
+                    self.retried += 1
+            else:
+                self.succeeded()
+                return result
+            finally:
+                self.release()
+            time.sleep(wait)
+
+    def acquire(self):
+        """Wait for a free slot, giving interactive calls priority"""
+        interactive = request_priority.get() == INTERACTIVE
+        with self.condition:
+            if interactive:
+                self.waiting_interactive += 1
+            try:
+                while True:
+                    pause = self.paused_until - time.monotonic()
+                    if pause <= 0 and self.running < self.concurrency and \
+                            (interactive or self.waiting_interactive == 0):
+                        break
+                    self.condition.wait(timeout=pause if pause > 0 else None)
+            finally:
+                if interactive:
+                    self.waiting_interactive -= 1
+            self.running += 1
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def succeeded(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def back_off(self, seconds=0.0):
+        """Slow down: halve the concurrency, and pause all calls for seconds"""
+        with self.condition:
+            self.throttled += 1
+            self.concurrency = max(1, self.concurrency // 2)
+            self.successes = 0
+            self.backed_off_at = time.monotonic()
+            self.paused_until = max(self.paused_until, self.backed_off_at + seconds)
+
+    def on_response(self, response, *args, **kwargs):
+        """requests response hook, noting each response's status and acting on Azure DevOps' rate limit headers"""
+        headers = response.headers
+        last_response.status = response.status_code
+        last_response.retry_after = None
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                last_response.retry_after = float(retry_after)
+            except ValueError:
+                # An HTTP date, which Azure DevOps doesn't send; back off as if there was no header
+                pass
+            self.back_off(last_response.retry_after or 0.0)
+            return
+        remaining = headers.get('X-RateLimit-Remaining')
+        limit = headers.get('X-RateLimit-Limit')
+        # Requests are being delayed, or are about to be
+        if headers.get('X-RateLimit-Delay') is not None or \
+                (remaining is not None and limit is not None and float(remaining) < float(limit) / 10):
+            # At most once a second, so the responses to calls already running don't take us straight down to 1
+            if time.monotonic() - self.backed_off_at >= 1.0:
+                self.back_off()
+
+    def stats(self):
+        with self.condition:
+            return {'concurrency': self.concurrency, 'running': self.running, 'shared': self.shared,
+                    'retried': self.retried, 'throttled': self.throttled}
+
+
+class ScheduledClient:
+    """Wraps an SDK client, sending every method call through a RequestScheduler"""
+    def __init__(self, client, scheduler, source):
+        self.client = client
+        self.scheduler = scheduler
+        self.source = source
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def scheduled(*args, **kwargs):
+            return self.scheduler.call(self.source, name, attr, *args, **kwargs)
+        return scheduled
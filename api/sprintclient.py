@@ -3,36 +3,123 @@
 This wraps the Work API; specifically it covers the parts to do with sprints/iterations
 """
 
-from azure.devops.connection import Connection
-from msrest.authentication import BasicAuthentication
-from azure.devops.v7_0.work_item_tracking.models import TeamContext
+import json
+import types
+from datetime import datetime
+
+from .lru import LRUCache
+
+def saved_date(sprint, name):
+    """A sprint's start_date or finish_date as an ISO string, or None if it hasn't one"""
+    value = getattr(sprint.attributes, name, None) if sprint.attributes is not None else None
+    return value.isoformat() if value is not None else None
+
+def load_date(value):
+    return datetime.fromisoformat(value) if value is not None else None
 
 class SprintClient:
-    def __init__(self, base_url, org, project, team, token):
-        credentials = BasicAuthentication('', token)
-        connection = Connection(base_url=f"{base_url}/{org}", creds=credentials)
-        self.client = connection.clients.get_work_client()
-        self.cache = WorkClientCache(self.client)
-        self.team_context = TeamContext(project=project, team=team)
+    def __init__(self, connection, project, team, cache_size=100, sprint_ttl=300, disk_cache=None):
+        """
+        connection is the ApiConnection shared with other clients.
+        disk_cache is an optional DiskCache, to remember the list of sprints between sessions.
+        """
+        self.client = connection.get_work_client()
+        self.cache = WorkClientCache(self.client, max_size=cache_size, ttl=sprint_ttl,
+                                     request_log=connection.request_log)
+        self.project = project
+        self.team = team
+        self.cached_team_context = None
+        self.disk_cache = disk_cache
     
+    @property
+    def team_context(self):
+        if self.cached_team_context is None:
+            # Here rather than at the top, as the SDK is slow to import
+            from azure.devops.v7_0.work_item_tracking.models import TeamContext
+            self.cached_team_context = TeamContext(project=self.project, team=self.team)
+        return self.cached_team_context
+
     def get_sprints(self):
         # This is not cached
-        return self.client.get_team_iterations(self.team_context)
+        sprints = self.client.get_team_iterations(self.team_context)
+        # So the cache can find sprints by path
+        self.cache.sprint_ids_by_path = {sprint.path: sprint.id for sprint in sprints}
+        if self.disk_cache is not None:
+            saved = [{'id': sprint.id, 'name': sprint.name, 'path': sprint.path,
+                      'time_frame': sprint.attributes.time_frame if sprint.attributes is not None else None,
+                      'start_date': saved_date(sprint, 'start_date'),
+                      'finish_date': saved_date(sprint, 'finish_date')}
+                     for sprint in sprints]
+            self.disk_cache.put_meta(f"sprints:{self.team}", json.dumps(saved))
+        return sprints
+
+    def get_saved_sprints(self):
+        """
+        The sprints as get_sprints last returned them (possibly in an earlier session), without a request.
+        These only have the id, name, path and attributes (time_frame, start_date and finish_date) of each sprint.
+        Empty if there are none saved.
+        """
+        saved = self.disk_cache.get_meta(f"sprints:{self.team}") if self.disk_cache is not None else None
+        if saved is None:
+            return []
+        sprints = [types.SimpleNamespace(id=sprint['id'], name=sprint['name'], path=sprint['path'],
+                                         attributes=types.SimpleNamespace(
+                                             time_frame=sprint['time_frame'],
+                                             start_date=load_date(sprint.get('start_date')),
+                                             finish_date=load_date(sprint.get('finish_date'))))
+                   for sprint in json.loads(saved)]
+        self.cache.sprint_ids_by_path = {sprint.path: sprint.id for sprint in sprints}
+        return sprints
     
+    def get_current_sprint(self, sprints):
+        """Get the current sprint, from the given sprints if they say which it is"""
+        for sprint in sprints:
+            if sprint.attributes is not None and sprint.attributes.time_frame == 'current':
+                return sprint
+        current = self.client.get_team_iterations(self.team_context, timeframe='current')
+        return current[0] if current else None
+
+    def get_sprint_path(self, sprint_id):
+        """The iteration path of a sprint from the last get_sprints, or None"""
+        for path, path_sprint_id in self.cache.sprint_ids_by_path.items():
+            if path_sprint_id == sprint_id:
+                return path
+        return None
+
     def get_sprint_cardrefs(self, sprint_id):
         return self.cache.get_iteration_work_items(self.team_context, sprint_id)
 
 
 class WorkClientCache:
-    def __init__(self, client):
+    def __init__(self, client, max_size=100, ttl=300, request_log=None):
         self.client = client
-        self.cache = {}
+        # Optional RequestLog, to record requests the cache saved us
+        self.request_log = request_log
+        # Sprint contents change often, so only keep them for ttl seconds
+        self.cache = LRUCache(max_size, ttl)
+        self.sprint_ids_by_path = {}
 
     def reset(self):
-        self.cache = {}
+        self.cache.clear()
+
+    def invalidate(self, card_ids, sprint_paths):
+        """
+        Drop cached sprint contents that may be out of date because the given cards changed:
+        sprints that contain any of the cards, and the given sprints (which the cards are now in).
+        """
+        card_ids = {int(card_id) for card_id in card_ids}
+        sprint_ids = {self.sprint_ids_by_path.get(path) for path in sprint_paths}
+        for key, cardrefs in self.cache.items():
+            if key[2] in sprint_ids or \
+                    any(cardref.target.id in card_ids for cardref in cardrefs.work_item_relations):
+                del self.cache[key]
 
     def get_iteration_work_items(self, team_context, sprint_id):
         key = (team_context.project, team_context.team, sprint_id)
-        if key not in self.cache:
-            self.cache[key] = self.client.get_iteration_work_items(team_context, sprint_id)
-        return self.cache[key]
\ No newline at end of file
+        cardrefs = self.cache.get(key)
+        if cardrefs is None:
+            cardrefs = self.client.get_iteration_work_items(team_context, sprint_id)
+            self.cache[key] = cardrefs
+        elif self.request_log is not None:
+            self.request_log.record('work', 'get_iteration_work_items', cached=True)
+        return cardrefs
\ No newline at end of file
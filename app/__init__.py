@@ -1,4 +1,7 @@
 
 from .cards_panel import *
 from .sprints_panel import *
+from .backlog_panel import *
+from .metrics_panel import *
+from .hud_panel import *
 from .app import *
\ No newline at end of file
@@ -1,26 +1,38 @@
 from enum import Enum
 
+from textual import work
 from textual.app import App, ComposeResult
 from textual.containers import Horizontal, Vertical
 from textual.binding import Binding
 from textual.widgets import Footer
 
-from app import CardsPanel, SprintsPanel
-from api import CardClient, SprintClient
+from app import CardsPanel, SprintsPanel, BacklogPanel, MetricsPanel, HudPanel, DONE_STATES
+from api import ApiConnection, CardClient, CardStore, SprintClient, DiskCache, RequestLog, CARD_FIELDS
 
 class CommandState(Enum):
     NORMAL = 1
     CHANGE_CARDSTATE = 2
     MOVE_CARD = 3
+    BACKLOG = 4
+    METRICS = 5
 
 class ABTerm(App):
     
     # These may contain duplicate hotkeys so long as the ACTION_LISTS do not overlap
     BINDINGS = [
         Binding("r", "refresh_cache", "Refresh Cache", show=True),
+        Binding("R", "reset_cache", "Reset Cache", show=False),
         Binding("s", "cmds_cardstate", "Change Card State", show=True),
         Binding("m", "cmds_move_card", "Move Card", show=True),
         Binding("o", "open_card_url", "Open Card URL", show=True),
+        Binding("h", "toggle_hud", "Perf HUD", show=False),
+        Binding("space", "toggle_select", "Select", show=True),
+        Binding("escape", "clear_selection", "Clear Selection", show=False),
+        Binding("x", "toggle_hide_done", "Hide Done", show=True),
+        Binding("u", "toggle_mine", "Mine", show=True),
+        Binding("f", "toggle_feature", "This Feature", show=True),
+        Binding("e", "toggle_backlog", "Epics", show=True),
+        Binding("v", "toggle_metrics", "Metrics", show=True),
         Binding("q", "quit", "Quit", show=True),
         Binding("escape", "cancel", "Cancel", show=False),
         
@@ -36,23 +48,45 @@ class ABTerm(App):
     
     # These actions are available in each command state
     ACTION_LISTS = {
-        CommandState.NORMAL: ["refresh_cache", "cmds_cardstate",  "cmds_move_card", 
-                              "open_card_url", "quit"],
+        CommandState.NORMAL: ["refresh_cache", "reset_cache", "cmds_cardstate",  "cmds_move_card", 
+                              "open_card_url", "toggle_select", "clear_selection", "toggle_hide_done",
+                              "toggle_mine", "toggle_feature", "toggle_backlog", "toggle_metrics", "toggle_hud",
+                              "quit"],
         CommandState.CHANGE_CARDSTATE: ["card_set_state", "cancel", "quit"],
         CommandState.MOVE_CARD: ["move_card", "move_card_to_backlog", "cancel", "quit"],
+        CommandState.BACKLOG: ["open_card_url", "toggle_backlog", "toggle_hud", "quit"],
+        CommandState.METRICS: ["toggle_metrics", "toggle_hud", "quit"],
     }
     
-    def __init__(self, base_url, org, project, team, token, **kwargs):
+    def __init__(self, base_url, org, project, team, token, history_workers=8, disk_cache=True,
+                 cache_size=20000, card_ttl=3600, sprint_ttl=300, prefetch_sprints=1,
+                 pool_size=16, timeout=30, trace=None, **kwargs):
         super().__init__(**kwargs)
         self.title = "Azure Boards Terminal"
         self.base_url = base_url
         self.organisation = org
         self.project = project
         self.team = team
-        self.sprint_client = SprintClient(base_url, org, project, team, token)
-        self.card_client = CardClient(base_url, org, project, token)
-        self.sprints_panel = SprintsPanel(self.sprint_client)
-        self.cards_panel = CardsPanel(self.sprint_client, self.card_client)
+        # Times every API request; trace is a file to also write each one to, as JSON lines
+        self.request_log = RequestLog(trace)
+        self.connection = ApiConnection(base_url, org, token, pool_size=pool_size, timeout=timeout,
+                                        request_log=self.request_log)
+        disk_cache = DiskCache(org, project) if disk_cache else None
+        self.sprint_client = SprintClient(self.connection, project, team, sprint_ttl=sprint_ttl, disk_cache=disk_cache)
+        self.card_client = CardClient(self.connection, project, history_workers=history_workers,
+                                      disk_cache=disk_cache, cache_size=cache_size, card_ttl=card_ttl,
+                                      card_fields=CARD_FIELDS)
+        self.sprints_panel = SprintsPanel(self.sprint_client, prefetch=prefetch_sprints)
+        # Records of the cards shown, indexed for lookups and local filtering
+        self.card_store = CardStore()
+        self.cards_panel = CardsPanel(self.sprint_client, self.card_client, self.card_store)
+        # Shown instead of the cards panel while browsing the backlog
+        self.backlog_panel = BacklogPanel(self.card_client, self.card_store)
+        self.backlog_panel.display = False
+        # Also shown instead of the cards panel
+        self.metrics_panel = MetricsPanel(self.card_client)
+        self.metrics_panel.display = False
+        self.hud_panel = HudPanel(self.request_log, self.card_client.cache, self.connection.scheduler)
         self.current_sprint_id = None
         self.current_card_id = None
         self.command_state = CommandState.NORMAL
@@ -62,8 +96,11 @@ class ABTerm(App):
             Horizontal(
                 self.sprints_panel,
                 self.cards_panel,
+                self.backlog_panel,
+                self.metrics_panel,
                 #self.card_detail_panel
             ),
+            self.hud_panel,
             Footer()
         )
 
@@ -79,13 +116,109 @@ class ABTerm(App):
     
     def action_refresh_cache(self):
         """
-        Reset caches, and re-get current sprint cards.
+        Refetch cards changed since the last refresh, and re-get current sprint cards.
         """
-        self.sprint_client.cache.reset()
-        self.card_client.cache.reset()
+        self.refresh_changed()
+
+    @work(exclusive=True, thread=True, group="refresh")
+    def refresh_changed(self):
+        """Worker: bring the caches up to date, off the UI thread."""
+        try:
+            changed_ids = self.card_client.refresh_changed(self.sprint_client)
+        except Exception as e:
+            self.call_from_thread(self.notify, f"Failed to refresh: {e}", severity="error")
+            return
+        self.call_from_thread(self.notify, f"{len(changed_ids)} changed cards refreshed")
+        self.call_from_thread(self.reload_cards)
+
+    def reload_cards(self):
+        """Re-get current sprint cards."""
         if self.current_sprint_id is not None:
             self.cards_panel.get_cards(self.current_sprint_id)
+
+    def action_reset_cache(self):
+        """
+        Reset caches (including the on-disk cache), and re-get current sprint cards.
+        """
+        self.sprint_client.cache.reset()
+        self.card_client.cache.reset()
+        self.reload_cards()
     
+    def action_toggle_hide_done(self):
+        """
+        Show or hide cards in DONE_STATES.
+        """
+        card_filter = self.cards_panel.card_filter
+        hide = not card_filter.exclude_states
+        self.cards_panel.card_filter = card_filter.replace(exclude_states=DONE_STATES if hide else None)
+        self.notify("Hiding done cards" if hide else "Showing done cards")
+        self.reload_cards()
+
+    def action_toggle_mine(self):
+        """
+        Show only cards assigned to me, or everyone's.
+        """
+        card_filter = self.cards_panel.card_filter
+        mine = not card_filter.assigned_to
+        self.cards_panel.card_filter = card_filter.replace(assigned_to='@Me' if mine else None)
+        self.notify("Showing only my cards" if mine else "Showing everyone's cards")
+        self.reload_cards()
+
+    def action_toggle_feature(self):
+        """
+        Show only the cards under the highlighted card's Feature, or all cards again.
+        """
+        if self.cards_panel.feature_id is not None:
+            self.cards_panel.show_feature(None)
+            return
+        record = self.card_store.get(self.current_card_id)
+        if record is None:
+            return
+        feature_id = record.id if record.type == "Feature" else record.feature_id
+        if feature_id is None:
+            self.notify("This card isn't under a Feature")
+            return
+        self.cards_panel.show_feature(feature_id)
+
+    def action_toggle_backlog(self):
+        """
+        Switch between the sprint's cards and a tree of the project's Epics.
+        """
+        browsing = not self.backlog_panel.display
+        self.backlog_panel.display = browsing
+        self.cards_panel.display = not browsing
+        if browsing:
+            self.command_state = CommandState.BACKLOG
+            self.backlog_panel.show()
+            self.call_after_refresh(self.backlog_panel.epic_tree.focus)
+        else:
+            self.command_state = CommandState.NORMAL
+            self.current_card_id = self.cards_panel.table.cursor_key
+            self.call_after_refresh(self.cards_panel.table.focus)
+        self.refresh_bindings()
+
+    def action_toggle_metrics(self):
+        """
+        Switch between the sprint's cards and velocity and flow metrics for every sprint.
+        """
+        showing = not self.metrics_panel.display
+        self.metrics_panel.display = showing
+        self.cards_panel.display = not showing
+        if showing:
+            self.command_state = CommandState.METRICS
+            self.metrics_panel.show(self.sprints_panel.sprints)
+            self.call_after_refresh(self.metrics_panel.table.focus)
+        else:
+            self.command_state = CommandState.NORMAL
+            self.call_after_refresh(self.cards_panel.table.focus)
+        self.refresh_bindings()
+
+    def action_toggle_hud(self):
+        """
+        Show or hide the request timings.
+        """
+        self.hud_panel.toggle()
+
     def action_open_card_url(self):
         """
         Open the selected card in the web browser.
@@ -96,7 +229,7 @@ class ABTerm(App):
     
     def action_cmds_cardstate(self):
         """
-        Enter command mode to change the state of the selected card.
+        Enter command mode to change the state of the selected cards (or the highlighted card).
         """
         if self.current_card_id is not None:
             self.command_state = CommandState.CHANGE_CARDSTATE
@@ -104,22 +237,46 @@ class ABTerm(App):
 
     def action_card_set_state(self, new_state: str):
         """
-        Change the state of the selected card to the specified state.
+        Change the state of the selected cards (or the highlighted card) to the specified state.
         """
-        if self.current_card_id is not None:
-            self.card_client.update_card_state(self.current_card_id, new_state)
-            # Refresh the cards panel
-            if self.current_sprint_id is not None:
-                # Keep the current cursor position
-                row_index = self.cards_panel.table.cursor_row
-                self.cards_panel.get_cards(self.current_sprint_id)
-                self.cards_panel.table.move_cursor(row=row_index)
+        cards = self.cards_panel.target_cards()
+        if len(cards) > 0:
+            # Show the change straight away, and undo it for any cards where the update fails
+            old_states = {card.id: card.fields['System.State'] for card in cards}
+            for card in cards:
+                card.fields['System.State'] = new_state
+                self.cards_panel.update_card_row(card)
+            self.write_cards_state(cards, old_states, new_state)
         self.command_state = CommandState.NORMAL
         self.refresh_bindings()
+
+    @work(thread=True, group="writes")
+    def write_cards_state(self, cards, old_states, new_state):
+        """Worker: send card state changes, off the UI thread."""
+        _, failed = self.card_client.update_cards_state([card.id for card in cards], new_state)
+        self.call_from_thread(self.finish_cards_state, cards, old_states, failed)
+
+    def finish_cards_state(self, cards, old_states, failed):
+        for card in cards:
+            if card.id in failed:
+                card.fields['System.State'] = old_states[card.id]
+            # Successful updates have also changed the card (e.g. its revision) from the response
+            self.cards_panel.update_card_row(card)
+        self.cards_panel.clear_selection()
+        self.report_updates("Updated", cards, failed)
+
+    def report_updates(self, verb, cards, failed):
+        """Notify the outcome of updating several cards."""
+        if len(failed) > 0:
+            errors = "\n".join(f"{card_id}: {error}" for card_id, error in failed.items())
+            self.notify(f"{verb} {len(cards) - len(failed)} of {len(cards)} cards. Failed:\n{errors}",
+                        severity="error")
+        elif len(cards) > 1:
+            self.notify(f"{verb} {len(cards)} cards")
     
     def action_cmds_move_card(self):
         """
-        Enter command mode to move the selected card to another sprint.
+        Enter command mode to move the selected cards (or the highlighted card) to another sprint.
         """
         if self.current_card_id is not None:
             self.command_state = CommandState.MOVE_CARD
@@ -127,45 +284,71 @@ class ABTerm(App):
     
     def action_move_card(self, offset: int):
         """
-        Move the selected card to the specified sprint.
+        Move the selected cards (or the highlighted card) to the specified sprint.
         """
-        if self.current_card_id is None:
+        cards = self.cards_panel.target_cards()
+        if len(cards) == 0:
             return
-        # Get the current sprint of the card
-        card = self.card_client.get_card(self.current_card_id)
-        current_sprint_path = card['fields'].get('System.IterationPath', None)
+        # Get the current sprint of the cards; they're all in the sprint shown
+        current_sprint_path = cards[0].fields.get('System.IterationPath', None)
         if current_sprint_path is None:
             return
         new_sprint = self.sprints_panel.get_sprint_by_offset(current_sprint_path, offset)
         if new_sprint is None:
             return
-        self.card_client.update_card_sprint(self.current_card_id, new_sprint.path, self.sprint_client)
-        # Refresh the cards panel
-        if self.current_sprint_id is not None:
-            # Keep the current cursor position, by index, irrespective of card changes
-            row_index = self.cards_panel.table.cursor_row
-            self.cards_panel.get_cards(self.current_sprint_id)
-            self.cards_panel.table.move_cursor(row=row_index)
+        self.move_cards_to(cards, new_sprint.path)
         self.command_state = CommandState.NORMAL
         self.refresh_bindings()
     
     def action_move_card_to_backlog(self):
         """
-        Move the selected card to the backlog.
+        Move the selected cards (or the highlighted card) to the backlog.
         """
-        if self.current_card_id is None:
+        cards = self.cards_panel.target_cards()
+        if len(cards) == 0:
             return
         backlog = self.project
-        self.card_client.update_card_sprint(self.current_card_id, f"{backlog}", self.sprint_client)
-        # Refresh the cards panel
-        if self.current_sprint_id is not None:
-            # Keep the current cursor position, by index, irrespective of card changes
-            row_index = self.cards_panel.table.cursor_row
-            self.cards_panel.get_cards(self.current_sprint_id)
-            self.cards_panel.table.move_cursor(row=row_index)
+        self.move_cards_to(cards, f"{backlog}")
         self.command_state = CommandState.NORMAL
         self.refresh_bindings()
-    
+
+    def move_cards_to(self, cards, sprint_path):
+        """
+        Move cards to the given sprint path.
+        They leave the table straight away, and any where the update fails come back.
+        """
+        previous_cards = list(self.cards_panel.cards)
+        self.cards_panel.remove_cards(cards)
+        self.write_cards_sprint(cards, sprint_path, self.current_sprint_id, previous_cards)
+
+    @work(thread=True, group="writes")
+    def write_cards_sprint(self, cards, sprint_path, sprint_id, previous_cards):
+        """Worker: send card sprint changes, off the UI thread."""
+        _, failed = self.card_client.update_cards_sprint([card.id for card in cards], sprint_path,
+                                                         self.sprint_client)
+        self.call_from_thread(self.finish_cards_sprint, cards, sprint_path, sprint_id, previous_cards, failed)
+
+    def finish_cards_sprint(self, cards, sprint_path, sprint_id, previous_cards, failed):
+        # Moved cards are now in another sprint; set it before storing them, so they are indexed under it
+        for card in cards:
+            if card.id not in failed:
+                card.fields['System.IterationPath'] = sprint_path
+        self.card_store.put_all(cards)
+        if len(failed) > 0 and self.current_sprint_id == sprint_id:
+            self.cards_panel.restore_cards([card for card in cards if card.id in failed], previous_cards)
+        self.report_updates("Moved", cards, failed)
+
+    def action_toggle_select(self):
+        """
+        Add the highlighted card to the selection, or remove it.
+        State changes and moves apply to all selected cards.
+        """
+        if self.current_card_id is not None:
+            self.cards_panel.toggle_selected(self.current_card_id)
+
+    def action_clear_selection(self):
+        self.cards_panel.clear_selection()
+
     def action_cancel(self):
         """
         Cancel the current command state, returning to normal mode.
@@ -0,0 +1,111 @@
+from textual import work
+from textual.app import ComposeResult
+from textual.widget import Widget
+from textual.widgets import Tree
+from textual.worker import get_current_worker
+from rich.text import Text
+
+from app.cards_panel import CARD_TYPE_COLOURS, DONE_STATES
+
+# Card types that can't have children, so aren't expandable
+LEAF_TYPES = ['Task']
+
+class BacklogPanel(Widget):
+    """A panel to browse the project's Epics, and expand them into their Features, stories and tasks."""
+
+    def __init__(self, card_client, card_store, **kwargs):
+        super().__init__(**kwargs)
+        self.card_client = card_client
+        # Records of shown cards, shared with the app
+        self.card_store = card_store
+        self.epic_tree = Tree("Epics")
+        self.epic_tree.show_root = False
+        # Whether the Epics have been (or are being) fetched
+        self.loaded = False
+        # Cards whose children have been (or are being) fetched
+        self.expanded_ids = set()
+        # Cards waiting to have their children fetched, so expanding several at once fetches them together
+        self.pending_ids = set()
+        # Tree nodes by card ID
+        self.nodes = {}
+
+    def compose(self) -> ComposeResult:
+        yield self.epic_tree
+
+    def show(self):
+        """Fetch the Epics, the first time the panel is shown."""
+        if not self.loaded:
+            self.loaded = True
+            self.fetch_epics()
+
+    @work(exclusive=True, thread=True, group="backlog")
+    def fetch_epics(self):
+        """Worker: fetch the Epics a page at a time, showing each page as it arrives, so they can be browsed at once."""
+        worker = get_current_worker()
+        try:
+            for epics in self.card_client.iter_epics(self.card_client.card_fields):
+                if worker.is_cancelled:
+                    return
+                self.app.call_from_thread(self.add_cards, self.epic_tree.root, epics)
+        except Exception as e:
+            self.app.call_from_thread(self.app.notify, f"Failed to fetch Epics: {e}", severity="error")
+
+    def add_cards(self, parent, cards):
+        """Add cards to the tree under a node."""
+        for record in self.card_store.put_all(cards):
+            self.nodes[record.id] = parent.add(self.card_label(record), data=record.id,
+                                               allow_expand=record.type not in LEAF_TYPES)
+
+    def card_label(self, record):
+        style = "dim" if record.state in DONE_STATES else ""
+        label = Text(str(record.id), style=f"on {CARD_TYPE_COLOURS.get(record.type, 'black')}")
+        label.append(f" {record.title}", style=style)
+        label.append(f"  {record.state}", style="dim")
+        return label
+
+    def on_tree_node_expanded(self, event):
+        """Fetch a card's children the first time it is expanded."""
+        card_id = event.node.data
+        if card_id is None or card_id in self.expanded_ids:
+            return
+        self.expanded_ids.add(card_id)
+        event.node.add_leaf(Text("…", style="dim"))
+        # Anything else expanded in the meantime is fetched in the same requests
+        if len(self.pending_ids) == 0:
+            self.call_later(self.fetch_pending)
+        self.pending_ids.add(card_id)
+
+    def fetch_pending(self):
+        card_ids, self.pending_ids = self.pending_ids, set()
+        self.fetch_children(card_ids)
+
+    @work(thread=True, group="backlog-children")
+    def fetch_children(self, card_ids):
+        """Worker: fetch the children of several cards at once."""
+        try:
+            children = self.card_client.get_children_batch(card_ids, self.card_client.card_fields)
+        except Exception as e:
+            self.app.call_from_thread(self.show_error, card_ids, e)
+            return
+        self.app.call_from_thread(self.show_children, children)
+
+    def show_children(self, children):
+        for card_id, cards in children.items():
+            node = self.nodes[card_id]
+            node.remove_children()
+            self.add_cards(node, cards)
+            if len(cards) == 0:
+                node.allow_expand = False
+
+    def show_error(self, card_ids, error):
+        """Report a failed fetch, and let the cards be expanded again to retry."""
+        for card_id in card_ids:
+            self.expanded_ids.discard(card_id)
+            self.nodes[card_id].remove_children()
+            self.nodes[card_id].collapse()
+        self.app.notify(f"Failed to fetch children: {error}", severity="error")
+
+    def on_tree_node_highlighted(self, event):
+        """Handle selection of a card from the tree."""
+        card_id = event.node.data
+        self.app.current_card_id = None if card_id is None else str(card_id)
@@ -1,8 +1,12 @@
+from textual import work
 from textual.app import ComposeResult
 from textual.widget import Widget
-from textual.widgets import DataTable
+from textual.worker import get_current_worker
 from rich.text import Text
 
+from api import CARD_FIELDS, CardFilter, DONE_STATES
+from app.virtual_table import VirtualTable
+
 CARD_TYPE_COLOURS = {
     "User Story": "#2a7fff",
     "Task": "#803300",
@@ -11,92 +15,236 @@ CARD_TYPE_COLOURS = {
     "Epic": "#e69138",
 }
 
-DONE_STATES = ['Development Completed', 'Ready for UAT', 'Closed', 'Removed']
+# (label, key, width) for each table column
+COLUMNS = [
+    ("ID", "id", 5),
+    ("Title", "title", 60),
+    ("State", "state", 15),
+    ("Assigned", "assigned", 9),
+    ("Feature", "feature", 35),
+    ("Epic", "epic", 35),
+    ("Initial", "initial", 20),
+]
 
 class CardsPanel(Widget):
     """A panel to display cards as a selectable list."""
 
-    def __init__(self, sprint_client, card_client, **kwargs):
+    def __init__(self, sprint_client, card_client, card_store, **kwargs):
         super().__init__(**kwargs)
-        self.table = DataTable()
-        self.table.cursor_type = "row"
+        # Rows are built from the card store as they scroll into view
+        self.table = VirtualTable(COLUMNS, self.card_row, self.row_signature)
         self.sprint_client = sprint_client
         self.card_client = card_client
+        # Records of shown cards, for lookups and local filtering; shared with the app
+        self.card_store = card_store
+        # The cards of the shown sprint, in order; the table may show only some of them
         self.cards = []
-
-    def on_mount(self):
-        self.table.add_column("ID", width=5)
-        self.table.add_column("Title", width=60)
-        self.table.add_column("State", width=15)
-        self.table.add_column("Assigned", width=9)
-        self.table.add_column("Feature", width=35)
-        self.table.add_column("Epic", width=35)
-        self.table.add_column("Initial", width=20)
+        # The cards in the table, by ID (as a string, like the table's keys)
+        self.shown_by_id = {}
+        # The sprint whose cards are in the table
+        self.shown_sprint_id = None
+        # IDs of cards selected for multi-card actions
+        self.selected_ids = set()
+        # Which cards to show; applied by the server
+        self.card_filter = CardFilter()
+        # If set, only cards under this Feature are shown; applied locally
+        self.feature_id = None
 
     def compose(self) -> ComposeResult:
         yield self.table
 
     def get_cards(self, sprint_id):
-        """Fetch cards for the given sprint ID."""
-        cards = self.card_client.get_sprint_cards(sprint_id, self.sprint_client)
-        self.cards = [self.card_client.get_card_and_parents(card) for card in cards]
-        self.cards = [self.card_client.add_initial_sprint(card) for card in self.cards]
+        """
+        Fetch cards for the given sprint ID in the background.
+        Any fetch already in progress is cancelled.
+        """
+        self.table.loading = True
+        self.fetch_cards(sprint_id)
+
+    @work(exclusive=True, thread=True, group="cards")
+    def fetch_cards(self, sprint_id):
+        """Worker: fetch and augment the cards for a sprint, off the UI thread."""
+        worker = get_current_worker()
+        label = self.app.sprints_panel.sprint_name(sprint_id)
+        try:
+            with self.card_client.foreground(), self.app.request_log.load(label):
+                self.fetch_cards_now(worker, sprint_id)
+        except Exception as e:
+            if not worker.is_cancelled:
+                self.app.call_from_thread(self.show_error, sprint_id, e)
+
+    def fetch_cards_now(self, worker, sprint_id):
+        """Fetch, augment and show the cards for a sprint, unless the worker is cancelled."""
+        if self.card_client.cache.stale:
+            # Catch up with changes made since the on-disk cache was last synced
+            self.card_client.refresh_changed(self.sprint_client)
+        cards = self.card_client.get_sprint_cards(sprint_id, self.sprint_client, self.card_filter)
+        if worker.is_cancelled:
+            return
+        cards = self.card_client.add_parents(cards)
+        if worker.is_cancelled:
+            return
+        # Show the cards now, and fill in initial sprints as the (slow) history lookups finish
+        self.app.call_from_thread(self.show_cards, sprint_id, cards)
+        for card in self.card_client.iter_initial_sprints(cards):
+            # Threads can't be interrupted, so check between each lookup
+            if worker.is_cancelled:
+                return
+            self.app.call_from_thread(self.show_initial_sprint, sprint_id, card)
+
+    def show_cards(self, sprint_id, cards):
+        """Display fetched cards, if their sprint is still the one selected."""
+        if sprint_id != self.app.current_sprint_id:
+            return
+        self.cards = cards
+        self.card_store.put_all(cards)
+        if sprint_id != self.shown_sprint_id:
+            # Only keep records of the cards shown here and in the backlog tree, not every sprint visited
+            self.card_store.retain([card.id for card in cards] + list(self.app.backlog_panel.nodes))
         self.update_table()
+        if sprint_id != self.shown_sprint_id:
+            # Start a new sprint from the top, with nothing selected
+            self.table.move_cursor(0)
+            self.shown_sprint_id = sprint_id
+            self.clear_selection()
+        self.table.loading = False
+
+    def show_initial_sprint(self, sprint_id, card):
+        """Fill in the initial sprint of a card, if it is still shown."""
+        if sprint_id != self.app.current_sprint_id:
+            return
+        self.card_store.put(card)
+        self.table.refresh_row(str(card.id))
+
+    def show_error(self, sprint_id, error):
+        """Report a failed fetch, if its sprint is still the one selected."""
+        if sprint_id != self.app.current_sprint_id:
+            return
+        self.table.loading = False
+        self.app.notify(f"Failed to fetch cards: {error}", severity="error")
     
+    def toggle_selected(self, card_id):
+        """Add or remove a card from the selection."""
+        card = self.card(card_id)
+        if card is None:
+            return
+        self.selected_ids ^= {str(card_id)}
+        self.update_card_row(card)
+
+    def clear_selection(self):
+        selected = [self.card(card_id) for card_id in self.selected_ids]
+        self.selected_ids = set()
+        for card in selected:
+            if card is not None:
+                self.update_card_row(card)
+
+    def target_cards(self):
+        """The cards an action applies to: the selected cards if there are any, otherwise the highlighted card."""
+        if len(self.selected_ids) > 0:
+            return [card for card in self.cards if str(card.id) in self.selected_ids]
+        card = self.card(self.app.current_card_id)
+        return [] if card is None else [card]
+
     def card(self, card_id):
-        """Get a card by its ID from the current list."""
-        for card in self.cards:
-            if str(card.id) == str(card_id):
-                return card
-        return None
+        """Get a card by its ID, if it is in the table."""
+        return None if card_id is None else self.shown_by_id.get(str(card_id))
+
+    def shown_cards(self):
+        """The cards to show in the table: self.cards, or only those under self.feature_id."""
+        if self.feature_id is None:
+            return self.cards
+        # Each record knows its Feature, so this works even when cards in between (e.g. a Task's Story) aren't shown
+        under_feature = self.card_store.find(feature_id=int(self.feature_id))
+        return [card for card in self.cards if card.id in under_feature]
+
+    def show_feature(self, feature_id):
+        """Show only the cards under a Feature, or all cards if feature_id is None. No fetching is needed."""
+        self.feature_id = feature_id
+        self.update_table()
 
     def update_table(self):
-        """Update the table with the fetched cards."""
-        self.table.clear()
-        for card in self.cards:
-            # Add a row for each card
-            # Checking type is Task works for us for indenting, 
-            # but the more generic solution would be to check if the parent is in the sprint
-            prefix = ""
-            if card.fields['System.WorkItemType'] == "Task":
-                prefix = "  "
-            card_type_colour = CARD_TYPE_COLOURS.get(
-                card.fields["System.WorkItemType"], "black"
-            )
-            text_style = ""
-            if card.fields['System.State'] in DONE_STATES:
-                text_style = "dim "
-            card_id = Text(str(card.id), style=f"on {card_type_colour}")
-            card_title = Text(prefix + card.fields['System.Title'], style=text_style)
-            card_state = Text(card.fields['System.State'], style=text_style)
-            card_initial_sprint = card.fields.get('Initial Sprint', "unknown")
-
-            # Extract first name from assigned user
-            if 'System.AssignedTo' in card.fields:
-                display_name = card.fields['System.AssignedTo']['displayName']
-                assigned_name = display_name.split()[0]  # Get first name
-            else:
-                assigned_name = "-"
-
-            card_assigned = Text(assigned_name, style=text_style)
-            card_feature = Text(card.fields.get('Parent Feature', {}).get('Title', "unknown"),
-                                style=text_style)
-            card_epic = Text(card.fields.get('Parent Epic', {}).get('Title', "unknown"),
-                             style=text_style)
-            self.table.add_row(
-                card_id,
-                card_title,
-                card_state,
-                card_assigned,
-                card_feature,
-                card_epic,
-                card_initial_sprint,
-                key=str(card.id)
-            )
-
-
-    def on_data_table_row_highlighted(self, event):
+        """
+        Update the table to show self.shown_cards(). Only rows that scroll into view are built,
+        and rows already built are only rebuilt if their card changed.
+        The cursor stays on the same card if it is still shown.
+        """
+        self.shown_by_id = {str(card.id): card for card in self.shown_cards()}
+        self.selected_ids &= set(self.shown_by_id)
+        self.table.set_rows(list(self.shown_by_id))
+        # The highlighted card may have changed without the cursor moving
+        self.app.current_card_id = self.table.cursor_key
+
+    def update_card_row(self, card):
+        """Redraw the row for a card that has been changed in place."""
+        self.card_store.put(card)
+        self.table.refresh_row(str(card.id))
+
+    def remove_cards(self, cards):
+        """Take cards out of the table (e.g. when they leave the sprint)."""
+        removed_ids = {str(card.id) for card in cards}
+        self.cards = [card for card in self.cards if str(card.id) not in removed_ids]
+        self.update_table()
+
+    def restore_cards(self, cards, previous_cards):
+        """Put removed cards back into the table, in their positions in previous_cards."""
+        wanted_ids = {str(card.id) for card in self.cards + cards}
+        self.cards = [card for card in previous_cards if str(card.id) in wanted_ids]
+        self.update_table()
+
+    def row_signature(self, card_id):
+        """Everything a card's row is built from that can change; the revision covers the card's own fields."""
+        record = self.card_store.get(card_id)
+        return (
+            record.rev,
+            record.state,
+            record.feature,
+            record.epic,
+            record.initial_sprint,
+            str(record.id) in self.selected_ids,
+        )
+
+    def card_row(self, card_id):
+        """Build the table cells for a card, from its CardRecord, in COLUMNS order."""
+        record = self.card_store.get(card_id)
+        # Checking type is Task works for us for indenting, 
+        # but the more generic solution would be to check if the parent is in the sprint
+        prefix = ""
+        if record.type == "Task":
+            prefix = "  "
+        card_type_colour = CARD_TYPE_COLOURS.get(record.type, "black")
+        text_style = ""
+        if record.state in DONE_STATES:
+            text_style = "dim "
+        card_id = Text(str(record.id), style=f"on {card_type_colour}")
+        title_style = text_style
+        if str(record.id) in self.selected_ids:
+            title_style += "reverse"
+        card_title = Text(prefix + record.title, style=title_style)
+        card_state = Text(record.state, style=text_style)
+        # Not looked up yet
+        card_initial_sprint = record.initial_sprint if record.initial_sprint is not None else "…"
+
+        # Extract first name from assigned user
+        if record.assigned:
+            assigned_name = record.assigned.split()[0]  # Get first name
+        else:
+            assigned_name = "-"
+
+        card_assigned = Text(assigned_name, style=text_style)
+        card_feature = Text(record.feature or "unknown", style=text_style)
+        card_epic = Text(record.epic or "unknown", style=text_style)
+        return [
+            card_id,
+            card_title,
+            card_state,
+            card_assigned,
+            card_feature,
+            card_epic,
+            card_initial_sprint,
+        ]
+
+    def on_virtual_table_highlighted(self, event):
         """Handle selection of a card from the table."""
-        self.app.current_card_id = event.row_key.value
+        self.app.current_card_id = event.key
     
  
\ No newline at end of file
@@ -0,0 +1,62 @@
+from textual.widgets import Static
+
+class HudPanel(Static):
+    """A panel showing how long API requests took, for the last sprint load and the whole session."""
+
+    DEFAULT_CSS = """
+    HudPanel {
+        height: auto;
+        max-height: 16;
+        border-top: solid $accent;
+        padding: 0 1;
+    }
+    """
+
+    def __init__(self, request_log, card_cache, scheduler, **kwargs):
+        super().__init__(**kwargs)
+        self.request_log = request_log
+        self.card_cache = card_cache
+        self.scheduler = scheduler
+        self.display = False
+        self.timer = None
+
+    def toggle(self):
+        self.display = not self.display
+        if self.display:
+            self.update_stats()
+            self.timer = self.set_interval(0.5, self.update_stats)
+        elif self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+
+    def update_stats(self):
+        lines = []
+        load = self.request_log.latest_load()
+        if load is not None:
+            lines += self.describe(f"Load: {load.label}", load, show_elapsed=True)
+        prefetch = self.request_log.latest_load(background=True)
+        if prefetch is not None:
+            lines += self.describe(f"Prefetch: {prefetch.label}", prefetch, show_elapsed=True, by_method=False)
+        lines += self.describe("Session", self.request_log.totals, by_method=False)
+        stats = self.card_cache.stats()
+        lines.append(f"  card cache: {stats['hits']} hits, {stats['misses']} misses, "
+                     f"{stats['evictions']} evictions, {stats['cards']} cards")
+        stats = self.scheduler.stats()
+        lines.append(f"  scheduler: {stats['running']} running, limit {stats['concurrency']}, "
+                     f"{stats['shared']} shared, {stats['retried']} retried, throttled {stats['throttled']} times")
+        self.update("\n".join(lines))
+
+    def describe(self, title, load, show_elapsed=False, by_method=True):
+        """Summary lines for a LoadStats"""
+        summary = (f"{title}: {load.requests} requests, {load.cached} from cache, "
+                   f"{load.latency:.2f}s in requests, {load.bytes / 1024:.0f} KiB")
+        if show_elapsed:
+            status = "took" if load.finished else "running for"
+            summary += f", {status} {load.elapsed():.2f}s"
+        lines = [summary]
+        if by_method:
+            for method, (requests, cached, latency, size) in sorted(load.by_method.items()):
+                average = latency / requests if requests else 0
+                lines.append(f"  {method}: {requests} requests (avg {average:.3f}s), "
+                             f"{cached} from cache, {size / 1024:.0f} KiB")
+        return lines
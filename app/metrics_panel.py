@@ -0,0 +1,85 @@
+from textual import work
+from textual.app import ComposeResult
+from textual.widget import Widget
+from textual.widgets import Static
+
+from api import DONE_STATES
+from app.virtual_table import VirtualTable
+
+# (label, key, width) for each table column
+COLUMNS = [
+    ("Sprint", "sprint", 18),
+    ("Start", "start_date", 10),
+    ("Committed", "committed", 9),
+    ("Added", "added", 5),
+    ("Done", "completed", 5),
+    ("Carried in", "carried_in", 10),
+    ("Carried over", "carried_over", 12),
+    ("Open", "open", 5),
+    ("Done %", "completion_rate", 6),
+    ("Cycle days", "cycle_time_median", 10),
+    ("85th %ile", "cycle_time_85th", 9),
+]
+
+class MetricsPanel(Widget):
+    """A panel of velocity and flow metrics for each sprint, worked out from the cached card histories."""
+
+    def __init__(self, card_client, **kwargs):
+        super().__init__(**kwargs)
+        self.card_client = card_client
+        # What the work in progress is now, from the cumulative flow
+        self.summary = Static()
+        self.table = VirtualTable(COLUMNS, self.sprint_row, self.row_signature, cursor_on_load=False)
+        # Rows of metrics, by sprint name
+        self.rows = {}
+
+    def compose(self) -> ComposeResult:
+        yield self.summary
+        yield self.table
+
+    def show(self, sprints):
+        """Work out the metrics for the given sprints in the background."""
+        self.summary.update("Reading card histories…")
+        self.fetch_metrics(sprints)
+
+    @work(exclusive=True, thread=True, group="metrics")
+    def fetch_metrics(self, sprints):
+        """Worker: catch up with the card histories (usually a request or two), then work out the metrics."""
+        try:
+            with self.app.request_log.load("Flow metrics"):
+                self.card_client.sync_history()
+            rows, flow = self.card_client.get_flow_metrics(sprints, DONE_STATES)
+        except Exception as e:
+            self.app.call_from_thread(self.summary.update, "")
+            self.app.call_from_thread(self.app.notify, f"Failed to work out metrics: {e}", severity="error")
+            return
+        self.app.call_from_thread(self.show_metrics, rows, flow)
+
+    def show_metrics(self, rows, flow):
+        self.rows = {row['sprint']: row for row in rows}
+        # Latest first, as in the sprints list
+        self.table.set_rows([row['sprint'] for row in reversed(rows)])
+        if len(rows) == 0:
+            self.summary.update("No sprints with dates to work out metrics for")
+        elif len(flow) == 0:
+            self.summary.update("No card histories for these sprints")
+        else:
+            date = flow[-1]['date']
+            counts = ", ".join(f"{entry['cards']} {entry['state']}" for entry in flow if entry['date'] == date)
+            self.summary.update(f"Cards on {date}: {counts}")
+
+    def row_signature(self, sprint_name):
+        return tuple(self.rows[sprint_name].values())
+
+    def sprint_row(self, sprint_name):
+        """Build the table cells for a sprint, in COLUMNS order."""
+        row = self.rows[sprint_name]
+        cells = []
+        for _, key, _ in COLUMNS:
+            value = row[key]
+            if value is None:
+                value = "-"
+            elif key == "completion_rate":
+                value = f"{value:.0%}"
+            cells.append(str(value))
+        return cells
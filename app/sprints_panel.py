@@ -1,48 +1,152 @@
 
+from textual import work
 from textual.app import ComposeResult
 from textual.widget import Widget
-from textual.widgets import Static, ListView, ListItem
+from textual.worker import get_current_worker
+
+from app.virtual_table import VirtualTable
 
 class SprintsPanel(Widget):
     """A panel to display sprints as a selectable list."""
 
-    def __init__(self, client, **kwargs):
+    def __init__(self, client, prefetch=1, **kwargs):
         super().__init__(**kwargs)
         self.styles.width = 20
         self.client = client
-        self.list_view = ListView()
+        # How many sprints either side of the current sprint to prefetch
+        self.prefetch = prefetch
+        # Rows are only built for the sprints in view
+        self.list_view = VirtualTable([("Sprint", "name", 18)], self.sprint_row, self.sprint_row,
+                                      show_header=False, cursor_on_load=False)
         self.sprints = []
+        # Positions in self.sprints, by sprint path and by sprint ID
+        self.index_by_path = {}
+        self.index_by_id = {}
+        # The sprint highlighted for being the current one, until the user picks another
+        self.highlighted_current = None
 
     def compose(self) -> ComposeResult:
         yield self.list_view
 
     def on_mount(self):
+        # Show the sprints saved last time straight away, then the live list when it arrives
+        self.set_sprints(self.client.get_saved_sprints()[::-1])
+        self.update_list_view()
+        self.highlight_current_sprint()
         self.get_sprints()
 
     def get_sprints(self):
-        """Fetch sprints from Azure DevOps and update the list view."""
-        self.sprints = self.client.get_sprints()[::-1]
-        self.update_list_view()
+        """Fetch sprints from Azure DevOps in the background, then update the list view."""
+        self.fetch_sprints()
+
+    @work(exclusive=True, thread=True, group="sprints")
+    def fetch_sprints(self):
+        """Worker: fetch the sprints, off the UI thread."""
+        try:
+            sprints = self.client.get_sprints()[::-1]
+        except Exception as e:
+            self.app.call_from_thread(self.app.notify, f"Failed to fetch sprints: {e}", severity="error")
+            return
+        self.app.call_from_thread(self.show_sprints, sprints)
+
+    def show_sprints(self, sprints):
+        """Show the live list of sprints, and start prefetching around the current one."""
+        changed = [(sprint.id, sprint.name) for sprint in sprints] != \
+                  [(sprint.id, sprint.name) for sprint in self.sprints]
+        self.set_sprints(sprints)
+        if changed:
+            self.update_list_view()
+        # The saved list may be from before the current sprint changed
+        self.highlight_current_sprint()
+        self.prefetch_sprints()
+
+    @work(exclusive=True, thread=True, group="prefetch")
+    def prefetch_sprints(self):
+        """
+        Worker: warm the caches for the current sprint and the self.prefetch sprints either side of it,
+        nearest first, so moving to them is fast, and cache the initial sprints of every card in the project.
+        If the card histories have been synced before (so only what changed since is read), that is done first,
+        leaving few cards to look up one by one; otherwise reading the whole history would hold up the sprints,
+        so it is done last.
+        This gives way to any fetch the user is waiting for.
+        """
+        worker = get_current_worker()
+        card_client = self.app.card_client
+        request_log = self.app.request_log
+        synced = card_client.cache.get_history_watermark()[0] is not None
+        try:
+            if synced:
+                self.sync_history(worker)
+            current = self.client.get_current_sprint(self.sprints)
+            if current is not None:
+                index = self.index_by_id[current.id]
+                nearby = [index]
+                for distance in range(1, self.prefetch + 1):
+                    nearby += [index - distance, index + distance]
+                for sprint_index in nearby:
+                    if worker.is_cancelled:
+                        return
+                    if 0 <= sprint_index < len(self.sprints):
+                        sprint = self.sprints[sprint_index]
+                        with request_log.load(f"{sprint.name} (prefetch)", background=True):
+                            card_client.prefetch_sprint(sprint.id, self.client, lambda: worker.is_cancelled)
+            if not synced:
+                self.sync_history(worker)
+        except Exception as e:
+            # Only an optimisation, so just log it
+            self.log.warning(f"Prefetching sprints failed: {e}")
+
+    def sync_history(self, worker):
+        with self.app.request_log.load("Card histories (prefetch)", background=True):
+            self.app.card_client.sync_history(lambda: worker.is_cancelled)
     
+    def set_sprints(self, sprints):
+        self.sprints = sprints
+        self.index_by_path = {sprint.path: index for index, sprint in enumerate(sprints)}
+        self.index_by_id = {sprint.id: index for index, sprint in enumerate(sprints)}
+
+    def sprint_name(self, sprint_id):
+        """The name of the sprint with the given ID, or the ID if we don't know it"""
+        index = self.index_by_id.get(sprint_id)
+        return sprint_id if index is None else self.sprints[index].name
+
     def get_sprint_by_offset(self, sprint_path, offset=1):
-        """Get the sprint N after/before the given sprint ID."""
-        for index, sprint in enumerate(self.sprints):
-            if sprint.path == sprint_path:
-                # minus, because sprints are in reverse chronological order
-                # positive offset means move to later sprint
-                new_index = index - offset
-                if 0 <= new_index < len(self.sprints):
-                    return self.sprints[new_index]
+        """Get the sprint N after/before the given sprint path."""
+        index = self.index_by_path.get(sprint_path)
+        if index is None:
+            return None
+        # minus, because sprints are in reverse chronological order
+        # positive offset means move to later sprint
+        new_index = index - offset
+        if 0 <= new_index < len(self.sprints):
+            return self.sprints[new_index]
         return None
 
+    def sprint_row(self, sprint_id):
+        """The cells of a sprint's row (which is also all it is built from)"""
+        return [self.sprint_name(sprint_id)]
+
     def update_list_view(self):
-        self.list_view.clear()
+        # Keeps the selected sprint highlighted if it is still there
+        self.list_view.set_rows([sprint.id for sprint in self.sprints])
+
+    def highlight_current_sprint(self):
+        """
+        Move the cursor to the current sprint (which shows its cards), if the sprints say which it is,
+        unless the user has already picked a sprint.
+        """
+        if self.list_view.cursor_key not in (None, self.highlighted_current):
+            return
         for sprint in self.sprints:
-            item = ListItem(Static(sprint.name), id='ID'+sprint.id)
-            self.list_view.append(item)
+            if sprint.attributes is not None and sprint.attributes.time_frame == 'current':
+                self.highlighted_current = sprint.id
+                self.list_view.move_cursor_to_key(sprint.id)
+                return
 
-    def on_list_view_highlighted(self, event):
+    def on_virtual_table_highlighted(self, event):
         """Handle selection of a sprint from the list."""
-        sprint_id = event.item.id[2:]
+        sprint_id = event.key
+        if sprint_id is None:
+            return
         self.app.current_sprint_id = sprint_id
         self.app.cards_panel.get_cards(sprint_id)
@@ -0,0 +1,207 @@
+from rich.segment import Segment
+from rich.text import Text
+from textual import events
+from textual.binding import Binding
+from textual.geometry import Size
+from textual.message import Message
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
+
+from api.lru import LRUCache
+
+class VirtualTable(ScrollView, can_focus=True):
+    """
+    A table of rows identified by key, where a row is only built when it scrolls into view.
+    The table holds just the keys in order; row_cells(key) builds a row's cells (Text or str, in column order),
+    and row_signature(key) says what they were built from, so rendered rows are cached until that changes.
+    Only about a screenful of rows is kept rendered, so memory doesn't grow with the number of rows.
+    """
+
+    BINDINGS = [
+        Binding("up", "cursor_up", "Up", show=False),
+        Binding("down", "cursor_down", "Down", show=False),
+        Binding("pageup", "page_up", "Page Up", show=False),
+        Binding("pagedown", "page_down", "Page Down", show=False),
+        Binding("home", "first", "First", show=False),
+        Binding("end", "last", "Last", show=False),
+    ]
+
+    COMPONENT_CLASSES = {"virtual-table--header", "virtual-table--cursor"}
+
+    DEFAULT_CSS = """
+    VirtualTable {
+        background: $surface;
+        color: $foreground;
+        & > .virtual-table--header {
+            text-style: bold;
+            background: $panel;
+        }
+        & > .virtual-table--cursor {
+            background: $block-cursor-blurred-background;
+            color: $block-cursor-blurred-foreground;
+        }
+        &:focus > .virtual-table--cursor {
+            background: $block-cursor-background;
+            color: $block-cursor-foreground;
+            text-style: $block-cursor-text-style;
+        }
+    }
+    """
+
+    class Highlighted(Message):
+        """The cursor moved to another row (key is None if the table is empty)"""
+        def __init__(self, table, key):
+            super().__init__()
+            self.table = table
+            self.key = key
+
+        @property
+        def control(self):
+            return self.table
+
+    def __init__(self, columns, row_cells, row_signature, show_header=True, cursor_on_load=True,
+                 cache_size=500, **kwargs):
+        """
+        columns are (label, key, width) for each column.
+        Without cursor_on_load, no row is highlighted until the user moves the cursor.
+        """
+        super().__init__(**kwargs)
+        self.columns = columns
+        self.row_cells = row_cells
+        self.row_signature = row_signature
+        self.show_header = show_header
+        self.cursor_on_load = cursor_on_load
+        self.keys = []
+        self.index_by_key = {}
+        self.cursor_row = None
+        # key -> (signature, rendered row)
+        self.strips = LRUCache(max_size=cache_size)
+        self.row_width = sum(width for _, _, width in columns) + len(columns) - 1
+
+    @property
+    def header_height(self):
+        return 1 if self.show_header else 0
+
+    @property
+    def row_count(self):
+        return len(self.keys)
+
+    @property
+    def cursor_key(self):
+        return None if self.cursor_row is None else self.keys[self.cursor_row]
+
+    def has_row(self, key):
+        return key in self.index_by_key
+
+    def set_rows(self, keys):
+        """
+        Show rows for the given keys, in order. Rows for keys already shown are only rebuilt if they changed.
+        The cursor stays on the same key if it is still shown, otherwise at the same position.
+        """
+        cursor_key = self.cursor_key
+        self.keys = list(keys)
+        self.index_by_key = {key: index for index, key in enumerate(self.keys)}
+        self.virtual_size = Size(self.row_width, len(self.keys) + self.header_height)
+        if cursor_key in self.index_by_key:
+            self.cursor_row = self.index_by_key[cursor_key]
+        elif self.cursor_row is not None or (self.cursor_on_load and len(self.keys) > 0):
+            self.cursor_row = min(self.cursor_row or 0, len(self.keys) - 1) if len(self.keys) > 0 else None
+        self.refresh()
+        if self.cursor_key != cursor_key:
+            self.post_message(self.Highlighted(self, self.cursor_key))
+
+    def refresh_row(self, key):
+        """Redraw a row, e.g. after what it is built from changed"""
+        index = self.index_by_key.get(key)
+        if index is not None:
+            self.refresh_line(index + self.header_height)
+
+    def move_cursor(self, row):
+        if len(self.keys) == 0:
+            return
+        row = max(0, min(row, len(self.keys) - 1))
+        if row == self.cursor_row:
+            return
+        previous, self.cursor_row = self.cursor_row, row
+        if previous is not None:
+            self.refresh_row(self.keys[previous])
+        self.refresh_row(self.keys[row])
+        self.scroll_to_cursor()
+        self.post_message(self.Highlighted(self, self.cursor_key))
+
+    def move_cursor_to_key(self, key):
+        if key in self.index_by_key:
+            self.move_cursor(self.index_by_key[key])
+
+    def scroll_to_cursor(self):
+        body_height = self.scrollable_content_region.height - self.header_height
+        top = self.scroll_offset.y
+        if self.cursor_row < top:
+            self.scroll_to(y=self.cursor_row, animate=False)
+        elif body_height > 0 and self.cursor_row >= top + body_height:
+            self.scroll_to(y=self.cursor_row - body_height + 1, animate=False)
+
+    def page_height(self):
+        return max(1, self.scrollable_content_region.height - self.header_height)
+
+    def action_cursor_up(self):
+        self.move_cursor(0 if self.cursor_row is None else self.cursor_row - 1)
+
+    def action_cursor_down(self):
+        self.move_cursor(0 if self.cursor_row is None else self.cursor_row + 1)
+
+    def action_page_up(self):
+        self.move_cursor((self.cursor_row or 0) - self.page_height())
+
+    def action_page_down(self):
+        self.move_cursor((self.cursor_row or 0) + self.page_height())
+
+    def action_first(self):
+        self.move_cursor(0)
+
+    def action_last(self):
+        self.move_cursor(len(self.keys) - 1)
+
+    def on_click(self, event: events.Click):
+        row = event.y - self.header_height + self.scroll_offset.y
+        if event.y >= self.header_height and 0 <= row < len(self.keys):
+            self.move_cursor(row)
+
+    def render_cells(self, cells):
+        """One line of cells, each fitted to its column's width"""
+        line = Text()
+        for index, ((_, _, width), cell) in enumerate(zip(self.columns, cells)):
+            cell = cell.copy() if isinstance(cell, Text) else Text(str(cell))
+            cell.truncate(width, overflow="ellipsis", pad=True)
+            if index > 0:
+                line.append(" ")
+            line.append_text(cell)
+        return Strip(line.render(self.app.console, end=""), self.row_width)
+
+    def row_strip(self, key):
+        """A row rendered, from the cache if it hasn't changed since"""
+        signature = self.row_signature(key)
+        cached = self.strips.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        strip = self.render_cells(self.row_cells(key))
+        self.strips[key] = (signature, strip)
+        return strip
+
+    def render_line(self, y):
+        scroll_x, scroll_y = self.scroll_offset
+        width = self.scrollable_content_region.width
+        base_style = self.rich_style
+        if y < self.header_height:
+            header = self.render_cells([label for label, _, _ in self.columns])
+            style = base_style + self.get_component_rich_style("virtual-table--header")
+            return header.crop_extend(scroll_x, scroll_x + width, style).apply_style(style)
+        row = y - self.header_height + scroll_y
+        if row >= len(self.keys):
+            return Strip.blank(width, base_style)
+        strip = self.row_strip(self.keys[row])
+        if row == self.cursor_row:
+            cursor_style = self.get_component_rich_style("virtual-table--cursor")
+            strip = Strip(Segment.apply_style(strip, post_style=cursor_style), strip.cell_length)
+            return strip.crop_extend(scroll_x, scroll_x + width, base_style + cursor_style).apply_style(base_style)
+        return strip.crop_extend(scroll_x, scroll_x + width, base_style).apply_style(base_style)
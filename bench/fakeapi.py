@@ -0,0 +1,382 @@
+"""
+A local stand-in for the Azure DevOps Work and Work Item Tracking APIs, serving a board from memory
+(generated, or recorded from a real board) with a configurable delay per request
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from azure.devops.v7_0.work.models import (
+    IterationWorkItems, TeamIterationAttributes, TeamSettingsIteration, WorkItemLink, WorkItemReference)
+from azure.devops.v7_0.work_item_tracking.models import (
+    ReportingWorkItemRevisionsBatch, WorkItem, WorkItemFieldUpdate, WorkItemQueryResult,
+    WorkItemReference as WitReference, WorkItemRelation, WorkItemUpdate)
+
+from api import InstrumentedClient, RequestScheduler, ScheduledClient, WIQL_LIMIT
+
+PARENT_LINK = 'System.LinkTypes.Hierarchy-Reverse'
+
+# Who @Me is in WIQL queries
+ME = 'Ann Example'
+
+# A WIQL condition the fake API understands: [field] = value, [field] IN (a, b), [field] NOT IN (...),
+# or [field] > number, [field] <= number, where values are quoted strings, numbers or @Me
+CONDITION = re.compile(r"\[([\w.]+)\] (=|>|<=|IN|NOT IN) (.+)")
+
+def wiql_values(operand):
+    """The values in a WIQL condition's operand"""
+    if operand == '@Me':
+        return [ME]
+    if "'" in operand:
+        return [value.replace("''", "'") for value in re.findall(r"'((?:[^']|'')*)'", operand)]
+    return [int(value) for value in re.findall(r"\d+", operand)]
+
+def wiql_matches(fields, conditions):
+    """Whether a card's fields pass the conditions of a WIQL query"""
+    for condition in conditions:
+        match = CONDITION.fullmatch(condition.strip())
+        if match is None:
+            continue
+        name, operator, operand = match.groups()
+        values = wiql_values(operand)
+        value = fields.get(name)
+        if isinstance(value, dict):
+            value = value.get('displayName')
+        if operator == '>':
+            passes = value is not None and value > values[0]
+        elif operator == '<=':
+            passes = value is not None and value <= values[0]
+        else:
+            passes = (value in values) != (operator == 'NOT IN')
+        if not passes:
+            return False
+    return True
+
+def parse_date(value):
+    return datetime.fromisoformat(value) if value is not None else None
+
+def timestamp(moment):
+    """A datetime as the API formats times"""
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def generate_sprints(project, sprint_count):
+    """sprint_count two-week sprints, oldest first, the last one the current one"""
+    first_start = datetime(2025, 1, 6)
+    sprints = []
+    for i in range(sprint_count):
+        start = first_start + timedelta(weeks=2 * i)
+        sprints.append({'id': f'sprint-{i}', 'name': f'Sprint {i}', 'path': f'{project}\\Sprint {i}',
+                        'time_frame': 'past' if i < sprint_count - 1 else 'current',
+                        'start_date': start.isoformat(), 'finish_date': (start + timedelta(days=11)).isoformat()})
+    return sprints
+
+class Board:
+    """
+    The cards and sprints the fake API serves.
+    cards maps card ID to {'rev', 'fields', 'initial_iteration', 'updates'} and optionally 'created', where
+    initial_iteration is the iteration path the card was created in, updates are the field changes get_updates
+    returns, and created are any other fields that were different when the card was created.
+    sprints are {'id', 'name', 'path', 'time_frame', 'start_date', 'finish_date'} (dates as ISO strings, or None),
+    oldest first, and sprint_cards maps sprint ID to card IDs.
+    """
+    def __init__(self, project, sprints, cards, sprint_cards):
+        self.project = project
+        self.sprints = sprints
+        self.cards = cards
+        self.sprint_cards = sprint_cards
+
+    @classmethod
+    def generate(cls, size, project='proj', sprint_count=7, seed=0):
+        """
+        A board whose middle sprint has size cards: a third user stories, the rest their tasks.
+        The stories belong to features (about one per 25 cards), which belong to epics.
+        A fifth of the stories were created in the backlog, so need their updates checked for an initial sprint.
+        """
+        rng = random.Random(seed)
+        sprints = generate_sprints(project, sprint_count)
+        sprint = sprints[sprint_count // 2]
+        cards = {}
+        def add(card_type, title, iteration, parent=None, state='Active', initial_iteration=None, updates=()):
+            card_id = len(cards) + 1
+            fields = {
+                'System.Id': card_id,
+                'System.TeamProject': project,
+                'System.WorkItemType': card_type,
+                'System.Title': title,
+                'System.State': state,
+                'System.IterationPath': iteration,
+                'System.AssignedTo': {'displayName': rng.choice(['Ann Example', 'Bo Example', 'Cy Example'])},
+                'System.ChangedDate': '2026-01-01T00:00:00Z',
+            }
+            if parent is not None:
+                fields['System.Parent'] = parent
+            cards[card_id] = {'rev': 1, 'fields': fields, 'initial_iteration': initial_iteration or iteration,
+                              'updates': list(updates)}
+            return card_id
+        epics = [add('Epic', f'Epic {i}', project) for i in range(size // 100 + 1)]
+        features = [add('Feature', f'Feature {i}', project, parent=rng.choice(epics)) for i in range(size // 25 + 1)]
+        sprint_ids = []
+        while len(sprint_ids) < size:
+            story_number = len(sprint_ids)
+            if rng.random() < 0.2:
+                # Created in the backlog, then moved into the sprint
+                story = add('User Story', f'Story {story_number}', sprint['path'], parent=rng.choice(features),
+                            initial_iteration=project,
+                            updates=[{'System.IterationLevel2': sprint['name']}])
+            else:
+                story = add('User Story', f'Story {story_number}', sprint['path'], parent=rng.choice(features))
+            sprint_ids.append(story)
+            for task_number in range(2):
+                if len(sprint_ids) < size:
+                    sprint_ids.append(add('Task', f'Task {story_number}.{task_number}', sprint['path'],
+                                          parent=story, state=rng.choice(['New', 'Active', 'Closed'])))
+        return cls(project, sprints, cards, {sprint['id']: sprint_ids})
+
+    @classmethod
+    def generate_flow(cls, size, project='proj', sprint_count=26, seed=0):
+        """
+        A board with a history to work out flow metrics from: sprint_count sprints (a year, by default),
+        each starting with size cards, a third user stories and the rest tasks.
+        Cards go from New to Active to Closed in their sprint. A fifth are created in the backlog and moved into
+        their sprint when it starts; a quarter aren't finished, so are carried over to the next sprint.
+        The current (last) sprint is a week in, so its later cards aren't finished yet.
+        """
+        rng = random.Random(seed)
+        sprints = generate_sprints(project, sprint_count)
+        starts = [datetime.fromisoformat(sprint['start_date']) for sprint in sprints]
+        today = starts[-1] + timedelta(weeks=1)
+        cards = {}
+        sprint_cards = {sprint['id']: [] for sprint in sprints}
+        for index, sprint in enumerate(sprints):
+            for number in range(size):
+                card_id = len(cards) + 1
+                card_type = 'User Story' if number % 3 == 0 else 'Task'
+                created = starts[index] - timedelta(days=rng.uniform(1, 10))
+                initial_iteration = project if rng.random() < 0.2 else sprint['path']
+                updates = []
+                if initial_iteration == project:
+                    updates.append({'System.IterationPath': sprint['path'], 'System.IterationLevel2': sprint['name'],
+                                    'System.ChangedDate': timestamp(starts[index])})
+                started = starts[index] + timedelta(days=rng.uniform(0, 5))
+                updates.append({'System.State': 'Active', 'System.ChangedDate': timestamp(started)})
+                last_sprint = sprint
+                finished = started + timedelta(days=rng.uniform(1, 8))
+                if index < sprint_count - 1 and rng.random() < 0.25:
+                    last_sprint = sprints[index + 1]
+                    moved = starts[index + 1] + timedelta(hours=1)
+                    updates.append({'System.IterationPath': last_sprint['path'],
+                                    'System.IterationLevel2': last_sprint['name'],
+                                    'System.ChangedDate': timestamp(moved)})
+                    finished = moved + timedelta(days=rng.uniform(1, 8))
+                if finished < today:
+                    updates.append({'System.State': 'Closed', 'System.ChangedDate': timestamp(finished)})
+                fields = {
+                    'System.Id': card_id,
+                    'System.TeamProject': project,
+                    'System.WorkItemType': card_type,
+                    'System.Title': f'{card_type} {card_id}',
+                    'System.State': 'New',
+                    'System.IterationPath': initial_iteration,
+                    'System.ChangedDate': timestamp(created),
+                }
+                for update in updates:
+                    fields.update(update)
+                fields.pop('System.IterationLevel2', None)
+                cards[card_id] = {'rev': len(updates) + 1, 'fields': fields,
+                                  'initial_iteration': initial_iteration,
+                                  'created': {'System.State': 'New', 'System.ChangedDate': timestamp(created)},
+                                  'updates': updates}
+                sprint_cards[last_sprint['id']].append(card_id)
+        return cls(project, sprints, cards, sprint_cards)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        cards = {int(card_id): card for card_id, card in data['cards'].items()}
+        return cls(data['project'], data['sprints'], cards, data['sprint_cards'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'project': self.project, 'sprints': self.sprints, 'cards': self.cards,
+                       'sprint_cards': self.sprint_cards}, f, default=str)
+
+    def largest_sprint(self):
+        """The ID of the sprint with the most cards"""
+        return max(self.sprint_cards, key=lambda sprint_id: len(self.sprint_cards[sprint_id]))
+
+
+class FakeApi:
+    """Counts requests and waits latency seconds for each, plus per_item seconds for each item in it"""
+    def __init__(self, board, latency=0.0, per_item=0.0):
+        self.board = board
+        self.latency = latency
+        self.per_item = per_item
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def request(self, items=1):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency + self.per_item * items)
+
+
+class FakeWorkItemTrackingClient:
+    """The parts of the Work Item Tracking client that abterm uses"""
+    def __init__(self, api):
+        self.api = api
+        self.board = api.board
+        # All the board's revisions, as the reporting revisions feed gives them, once worked out
+        self.feed = None
+
+    def work_item(self, card_id, fields=None, expand=None):
+        card = self.board.cards[int(card_id)]
+        card_fields = card['fields']
+        if fields:
+            card_fields = {name: value for name, value in card_fields.items() if name in fields}
+        relations = None
+        if expand in ('relations', 'all') and 'System.Parent' in card['fields']:
+            relations = [WorkItemRelation(rel=PARENT_LINK, attributes={'name': 'Parent'},
+                                          url=self.url(card['fields']['System.Parent']))]
+        return WorkItem(id=int(card_id), rev=card['rev'], fields=dict(card_fields), relations=relations,
+                        url=self.url(card_id))
+
+    def url(self, card_id):
+        return f"https://dev.azure.com/fake/_apis/wit/workItems/{card_id}"
+
+    def get_work_item(self, id, project=None, fields=None, as_of=None, expand=None):
+        self.api.request()
+        return self.work_item(id, fields, expand)
+
+    def get_work_items_batch(self, work_item_get_request, project=None):
+        ids = work_item_get_request.ids
+        self.api.request(len(ids))
+        return [self.work_item(card_id, work_item_get_request.fields, work_item_get_request.expand)
+                for card_id in ids if int(card_id) in self.board.cards]
+
+    def get_revisions(self, id, project=None, top=None, skip=None, expand=None):
+        self.api.request()
+        first = self.first_fields(self.board.cards[int(id)])
+        return [WorkItem(id=int(id), rev=1, fields=first, url=self.url(id))]
+
+    def get_updates(self, id, project=None, top=None, skip=None):
+        self.api.request()
+        return [WorkItemUpdate(fields={name: WorkItemFieldUpdate(new_value=value) for name, value in update.items()})
+                for update in self.board.cards[int(id)]['updates']]
+
+    def first_fields(self, card):
+        """A card's fields as they were when it was created"""
+        return {**card['fields'], **card.get('created', {}), 'System.IterationPath': card['initial_iteration']}
+
+    def revisions(self, card_id):
+        """A card's revisions, as the reporting revisions feed gives them: its first version, then each update"""
+        card = self.board.cards[card_id]
+        fields = self.first_fields(card)
+        levels = card['initial_iteration'].split('\\')
+        fields.pop('System.IterationLevel2', None)
+        if len(levels) > 1:
+            fields['System.IterationLevel2'] = levels[1]
+        revisions = [{'id': card_id, 'rev': 1, 'fields': fields}]
+        for update in card['updates']:
+            fields = dict(fields, **update)
+            revisions.append({'id': card_id, 'rev': len(revisions) + 1, 'fields': fields})
+        return revisions
+
+    def read_reporting_revisions_get(self, project=None, fields=None, types=None, continuation_token=None,
+                                     start_date_time=None, include_identity_ref=None, include_deleted=None,
+                                     include_tag_ref=None, include_latest_only=None, expand=None,
+                                     include_discussion_changes_only=None, max_page_size=None):
+        # The continuation token is the position in the feed of all the board's revisions
+        start = int(continuation_token or 0)
+        page_size = max_page_size or 1000
+        if self.feed is None:
+            self.feed = [revision for card_id in sorted(self.board.cards) for revision in self.revisions(card_id)]
+        feed = self.feed
+        page = feed[start:start+page_size]
+        self.api.request(len(page))
+        if fields:
+            page = [dict(revision, fields={name: value for name, value in revision['fields'].items()
+                                           if name in fields})
+                    for revision in page]
+        # As the real client returns it: the SDK's model declares no attributes, so everything is left over
+        batch = ReportingWorkItemRevisionsBatch()
+        batch.additional_properties = {'values': page, 'continuationToken': str(start + len(page)),
+                                       'isLastBatch': start + len(page) >= len(feed)}
+        return batch
+
+    def query_by_wiql(self, wiql, team_context=None, time_precision=None, top=None):
+        self.api.request()
+        # Nothing changes on a fake board, so change queries find nothing
+        if 'ChangedDate' in wiql.query:
+            card_ids = []
+        else:
+            query, _, order = wiql.query.partition(' ORDER BY ')
+            conditions = query.split(' WHERE ', 1)[1].split(' AND ') if ' WHERE ' in query else []
+            card_ids = [card_id for card_id, card in self.board.cards.items()
+                        if wiql_matches(card['fields'], conditions)]
+            if order:
+                card_ids.sort(reverse=order.endswith('DESC'))
+        # As the real API does, refuse queries that would return too much, unless they say how much they want
+        if top is None and len(card_ids) > WIQL_LIMIT:
+            raise Exception(f"VS402337: The number of work items returned exceeds the size limit of {WIQL_LIMIT}.")
+        card_ids = card_ids[:top]
+        return WorkItemQueryResult(work_items=[WitReference(id=card_id) for card_id in card_ids])
+
+    def update_work_item(self, document, id, project=None, validate_only=None, bypass_rules=None,
+                         suppress_notifications=None, expand=None):
+        self.api.request()
+        card = self.board.cards[int(id)]
+        for operation in document:
+            card['fields'][operation.path.rsplit('/', 1)[-1]] = operation.value
+        card['rev'] += 1
+        self.feed = None
+        return self.work_item(id, expand=expand)
+
+
+class FakeWorkClient:
+    """The parts of the Work client that abterm uses"""
+    def __init__(self, api):
+        self.api = api
+        self.board = api.board
+
+    def get_team_iterations(self, team_context, timeframe=None):
+        self.api.request()
+        sprints = [sprint for sprint in self.board.sprints
+                   if timeframe is None or sprint.get('time_frame') == timeframe]
+        return [TeamSettingsIteration(id=sprint['id'], name=sprint['name'], path=sprint['path'],
+                                      attributes=TeamIterationAttributes(time_frame=sprint.get('time_frame'),
+                                                                         start_date=parse_date(sprint.get('start_date')),
+                                                                         finish_date=parse_date(sprint.get('finish_date'))))
+                for sprint in sprints]
+
+    def get_iteration_work_items(self, team_context, iteration_id):
+        card_ids = self.board.sprint_cards.get(iteration_id, [])
+        self.api.request(len(card_ids))
+        return IterationWorkItems(work_item_relations=[WorkItemLink(target=WorkItemReference(id=card_id))
+                                                       for card_id in card_ids])
+
+
+class FakeConnection:
+    """Stands in for an ApiConnection, handing out clients for the fake API"""
+    def __init__(self, board, latency=0.0, per_item=0.0, request_log=None, pool_size=16):
+        self.api = FakeApi(board, latency=latency, per_item=per_item)
+        self.request_log = request_log
+        self.scheduler = RequestScheduler(max_concurrency=pool_size)
+
+    def get_work_item_tracking_client(self):
+        return self.schedule(self.instrument(FakeWorkItemTrackingClient(self.api), 'wit'), 'wit')
+
+    def get_work_client(self):
+        return self.schedule(self.instrument(FakeWorkClient(self.api), 'work'), 'work')
+
+    def schedule(self, client, source):
+        return ScheduledClient(client, self.scheduler, source)
+
+    def instrument(self, client, source):
+        if self.request_log is None:
+            return client
+        return InstrumentedClient(client, self.request_log, source)
@@ -0,0 +1,61 @@
+"""
+Records a real board (using config.txt) as a fixture the fake API can replay:
+
+    python -m bench.record board.json [--sprints 3]
+"""
+
+import argparse
+
+from abterm import BASE_URL, read_config
+from api import ApiConnection, CardClient, SprintClient, saved_date
+from bench.fakeapi import Board
+
+# Fields of a card's first revision to record, as the cards' histories (for flow metrics) start from them
+CREATED_FIELDS = ['System.State', 'System.ChangedDate']
+
+def record(card_client, sprint_client, sprint_count):
+    """A Board of the current sprint and the sprint_count - 1 before it, and all their cards' parents"""
+    sprints = sprint_client.get_sprints()
+    current = sprint_client.get_current_sprint(sprints)
+    index = [sprint.id for sprint in sprints].index(current.id) if current is not None else len(sprints) - 1
+    recorded = sprints[max(0, index - sprint_count + 1):index + 1]
+    cards = {}
+    sprint_cards = {}
+    for sprint in recorded:
+        cardrefs = sprint_client.get_sprint_cardrefs(sprint.id)
+        sprint_cards[sprint.id] = [cardref.target.id for cardref in cardrefs.work_item_relations]
+        for card in card_client.get_cards_batch(sprint_cards[sprint.id]):
+            cards[card.id] = card
+    # Parents, a level of the hierarchy at a time
+    parent_ids = {card.fields.get('System.Parent') for card in cards.values()} - set(cards) - {None}
+    while len(parent_ids) > 0:
+        parents = card_client.get_cards_batch(parent_ids)
+        for parent in parents:
+            cards[parent.id] = parent
+        parent_ids = {parent.fields.get('System.Parent') for parent in parents} - set(cards) - {None}
+    board_cards = {}
+    for card_id, card in cards.items():
+        first = card_client.client.get_revisions(card_id, top=1)[0]
+        updates = [{name: change.new_value for name, change in update.fields.items()}
+                   for update in card_client.client.get_updates(card_id) if update.fields]
+        board_cards[card_id] = {'rev': card.rev, 'fields': card.fields,
+                                'initial_iteration': first.fields.get('System.IterationPath', ''),
+                                'created': {name: first.fields[name] for name in CREATED_FIELDS
+                                            if name in first.fields},
+                                'updates': updates}
+    board_sprints = [{'id': sprint.id, 'name': sprint.name, 'path': sprint.path,
+                      'time_frame': sprint.attributes.time_frame if sprint.attributes is not None else None,
+                      'start_date': saved_date(sprint, 'start_date'), 'finish_date': saved_date(sprint, 'finish_date')}
+                     for sprint in recorded]
+    return Board(card_client.project, board_sprints, board_cards, sprint_cards)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record a board as a fixture for bench.run")
+    parser.add_argument('path', help="the file to write the fixture to")
+    parser.add_argument('--sprints', type=int, default=3, help="how many sprints to record, up to the current one")
+    args = parser.parse_args()
+    config = read_config()
+    connection = ApiConnection(BASE_URL, config['ORGANISATION'], config['TOKEN'])
+    sprint_client = SprintClient(connection, config['PROJECT'], config['TEAM'])
+    card_client = CardClient(connection, config['PROJECT'])
+    record(card_client, sprint_client, args.sprints).save(args.path)
@@ -0,0 +1,175 @@
+"""
+Benchmarks of sprint loading against the fake API, reporting requests made, wall time and peak memory,
+so changes to the number of round trips show up as numbers.
+
+    python -m bench.run [--sizes 50,500,5000] [--latency 0.005] [--fixture board.json]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+
+import app.app
+from api import CardClient, RequestLog, SprintClient
+from app import ABTerm
+from bench.fakeapi import Board, FakeConnection
+
+def sprint_cards(card_client, sprint_client, sprint_id):
+    card_client.get_sprint_cards(sprint_id, sprint_client)
+
+def card_and_parents(card_client, sprint_client, sprint_id, cards):
+    for card in cards:
+        card_client.get_card_and_parents(card)
+
+def add_parents(card_client, sprint_client, sprint_id, cards):
+    card_client.add_parents(cards)
+
+def initial_sprints(card_client, sprint_client, sprint_id, cards):
+    for card in cards:
+        card_client.add_initial_sprint(card)
+
+def parallel_initial_sprints(card_client, sprint_client, sprint_id, cards):
+    for card in card_client.iter_initial_sprints(cards):
+        pass
+
+def sync_history(card_client, sprint_client, sprint_id):
+    # Covers every card on the board, not just the sprint's
+    card_client.sync_history()
+
+def flow_metrics(card_client, sprint_client, sprint_id, sprints):
+    card_client.get_flow_metrics(sprints)
+
+def fetched_cards(card_client, sprint_client, sprint_id):
+    """The sprint's cards"""
+    return [card_client.get_sprint_cards(sprint_id, sprint_client)]
+
+def synced_history(card_client, sprint_client, sprint_id):
+    """Every sprint, with the history of every card cached (so the caches are warm)"""
+    card_client.sync_history()
+    return [sprint_client.get_sprints()]
+
+# name -> (function, and None or a function fetching more arguments for it)
+CLIENT_SCENARIOS = {
+    'get_sprint_cards': (sprint_cards, None),
+    'get_card_and_parents': (card_and_parents, fetched_cards),
+    'add_parents': (add_parents, fetched_cards),
+    'add_initial_sprint': (initial_sprints, fetched_cards),
+    'iter_initial_sprints': (parallel_initial_sprints, fetched_cards),
+    'sync_history': (sync_history, None),
+    'flow_metrics': (flow_metrics, synced_history),
+}
+
+# Scenarios run against a board with a year of sprints (of the given size) and their history, when generating boards
+FLOW_SCENARIOS = ['flow_metrics']
+
+SCENARIOS = list(CLIENT_SCENARIOS) + ['CardsPanel.get_cards']
+
+def run_client_scenario(name, board, latency, per_item):
+    """
+    Run a scenario against fresh (empty) caches, other than what its setup fetches,
+    returning (requests, cache hits, seconds, peak bytes)
+    """
+    function, setup = CLIENT_SCENARIOS[name]
+    request_log = RequestLog()
+    connection = FakeConnection(board, latency=latency, per_item=per_item, request_log=request_log)
+    sprint_client = SprintClient(connection, board.project, 'team')
+    card_client = CardClient(connection, board.project)
+    sprint_id = board.largest_sprint()
+    args = [card_client, sprint_client, sprint_id]
+    if setup is not None:
+        # Setting up isn't part of what's measured
+        args += setup(card_client, sprint_client, sprint_id)
+    tracemalloc.start()
+    start = time.perf_counter()
+    with request_log.load(name) as load:
+        function(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return load.requests, load.cached, seconds, peak
+
+def run_panel_scenario(board, latency, per_item):
+    """Load the largest sprint into the cards table of a headless ABTerm"""
+    def fake_connection(base_url, org, token, request_log=None, **kwargs):
+        return FakeConnection(board, latency=latency, per_item=per_item, request_log=request_log)
+    real_connection = app.app.ApiConnection
+    app.app.ApiConnection = fake_connection
+    try:
+        return asyncio.run(load_in_panel(board))
+    finally:
+        app.app.ApiConnection = real_connection
+
+async def load_in_panel(board):
+    abterm = ABTerm("https://dev.azure.com", "fake", board.project, "team", "", disk_cache=False)
+    sprint_id = board.largest_sprint()
+    async with abterm.run_test() as pilot:
+        await pilot.pause()
+        # Let prefetching finish, so it doesn't skew the numbers
+        await abterm.workers.wait_for_complete()
+        abterm.card_client.cache.reset()
+        abterm.sprint_client.cache.reset()
+        tracemalloc.start()
+        start = time.perf_counter()
+        abterm.cards_panel.get_cards(sprint_id)
+        await pilot.pause()
+        await abterm.workers.wait_for_complete()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        load = abterm.request_log.latest_load()
+        return load.requests, load.cached, seconds, peak
+
+def run_scenario(name, board, latency, per_item):
+    if name == 'CardsPanel.get_cards':
+        return run_panel_scenario(board, latency, per_item)
+    return run_client_scenario(name, board, latency, per_item)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark sprint loading against a fake Azure DevOps API")
+    parser.add_argument('--sizes', default='50,500,5000',
+                        help="comma-separated numbers of cards in the generated sprint (default: 50,500,5000)")
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help="seconds each fake request takes (default: 0.005)")
+    parser.add_argument('--per-item', type=float, default=0.0,
+                        help="extra seconds each fake request takes per card in it (default: 0)")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma-separated scenarios to run (default: all of {','.join(SCENARIOS)})")
+    parser.add_argument('--fixture', metavar='FILE',
+                        help="replay a recorded board (see bench.record) instead of generating boards")
+    parser.add_argument('--save-fixture', metavar='FILE',
+                        help="save each generated board, as FILE with the size inserted before the extension")
+    parser.add_argument('--output', metavar='FILE', help="also append each result to FILE as a line of JSON")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.fixture:
+        boards = [(args.fixture, Board.load(args.fixture))]
+    else:
+        boards = [(int(size), Board.generate(int(size))) for size in args.sizes.split(',')]
+    output = open(args.output, 'a') if args.output else None
+    print(f"{'scenario':<24}{'board':>10}{'requests':>10}{'cached':>10}{'seconds':>10}{'peak MiB':>10}")
+    for board_name, board in boards:
+        if args.save_fixture and not args.fixture:
+            stem, dot, extension = args.save_fixture.rpartition('.')
+            board.save(f"{stem}-{board_name}.{extension}" if dot else f"{args.save_fixture}-{board_name}")
+        flow_board = None
+        for name in args.scenarios.split(','):
+            scenario_board = board
+            if name in FLOW_SCENARIOS and not args.fixture:
+                if flow_board is None:
+                    flow_board = Board.generate_flow(board_name)
+                scenario_board = flow_board
+            requests, cached, seconds, peak = run_scenario(name, scenario_board, args.latency, args.per_item)
+            print(f"{name:<24}{board_name:>10}{requests:>10}{cached:>10}{seconds:>10.3f}{peak / 2**20:>10.1f}")
+            if output is not None:
+                output.write(json.dumps({'scenario': name, 'board': board_name, 'latency': args.latency,
+                                         'requests': requests, 'cached': cached, 'seconds': round(seconds, 4),
+                                         'peak_bytes': peak}) + '\n')
+    if output is not None:
+        output.close()
+
+if __name__ == "__main__":
+    main()